@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks parsing and Redis writes on a synthetic Game.log.
+#
+#   python bench.py --fake                      in-process fake Redis (needs fakeredis)
+#   python bench.py --redis redis://localhost:6379/15
+#   python bench.py --fake --output new.json --compare old.json
+#
+# The Redis database is flushed before each storage layout, so never point
+# this at a database that holds real data
+
+PLAYER = "BenchPilot"
+DEFAULT_LINES = 200000
+DEFAULT_REDIS_URL = "redis://localhost:6379/15"
+
+# Share of generated lines per kind, the rest is noise. Roughly the mix of a
+# busy combat session
+LINE_MIX = {
+    "own_death": 0.01,
+    "nearby_death": 0.02,
+    "location": 0.05,
+    "ship_entry": 0.02,
+    "ship_destruction": 0.01,
+    "connection": 0.002,
+}
+
+SHIPS = ["ANVL_Hornet_F7A_Mk2", "AEGS_Gladius", "ORIG_m50", "DRAK_Cutlass_Black", "MISC_Freelancer", "RSI_Constellation_Andromeda"]
+LOCATIONS = ["Stanton1_Lorville", "Stanton2_Orison", "Stanton3_Area18", "Stanton4_NewBabbage"]
+NOISE_TAGS = ["CSCLoadingPlatformManager::OnLoadingStateChanged", "ContextEstablisherTaskFinished", "Spawn Flow",
+              "StatObjLoad 0x800 Format", "UpdateNotificationItem", "SHUDEvent_OnNotification"]
+
+# Storage layouts to compare, as config.json settings
+LAYOUTS = {
+    "json": {},
+    "streams": {"storage": "streams"},
+    "compact": {"event_format": "compact"},
+    "hash_fleet": {"fleet_storage": "hash"},
+    "aggregates": {"aggregates": True},
+    "sharded": {"key_layout": "sharded"},
+}
+
+def mix_bounds(mix):
+    # Cumulative shares, for picking a kind of line with one random number
+    bounds = []
+    total = 0
+    for kind in mix:
+        total += mix[kind]
+        bounds.append(total)
+    return list(mix), bounds
+
+def pick_kind(rnd, kinds, bounds):
+    x = rnd.random()
+    return next((kind for kind, bound in zip(kinds, bounds) if x < bound), "noise")
+
+def stamp(rnd, clock):
+    return time.strftime("<%Y-%m-%dT%H:%M:%S", time.gmtime(clock)) + ".%03dZ>" % rnd.randrange(1000)
+
+def login_line(rnd, clock, player):
+    return f"{stamp(rnd, clock)} [Notice] <AccountLoginCharacterStatus_Character> Character: createdAt 1700000000000 - updatedAt 1700000000000 - geid 200000000001 - accountId 100001 - name {player} - state STATE_CURRENT [Team_GameServices][Login]\n"
+
+def log_line(rnd, clock, player, names, kind, i, locations=LOCATIONS):
+    # One line of the given kind, written at clock by player among names
+    def ship():
+        return f"{rnd.choice(SHIPS)}_{rnd.randrange(10**12, 10**13)}"
+
+    other = rnd.choice(names)
+    if kind == "own_death":
+        victim, killer = (player, other) if rnd.random() < 0.5 else (other, player)
+        return f"{stamp(rnd, clock)} [Notice] <Actor Death> CActor::Kill: '{victim}' [200000000002] in zone '{ship()}' killed by '{killer}' [200000000001] using 'KLWE_LaserRepeater_S3_123' [Class KLWE_LaserRepeater_S3] with damage type 'VehicleDestruction' from direction x: 0, y: 0, z: 0 [Team_ActorTech][Actor]\n"
+    if kind == "nearby_death":
+        return f"{stamp(rnd, clock)} [Notice] <Actor Death> CActor::Kill: '{other}' [200000000002] in zone 'Stanton' killed by '{rnd.choice(names)}' [200000000003] using 'unknown' [Class unknown] with damage type 'Bullet' from direction x: 0, y: 0, z: 0 [Team_ActorTech][Actor]\n"
+    if kind == "location":
+        return f"{stamp(rnd, clock)} [Notice] <RequestLocationInventory> Player[{player}] requested inventory for Location[{rnd.choice(locations)}] [Team_CoreGameplayFeatures][Inventory]\n"
+    if kind == "ship_entry":
+        return f"{stamp(rnd, clock)} [Notice] <CEntityComponentInstancedInterior::OnEntityEnterZone> [InstancedInterior] OnEntityEnterZone - InstancedInterior [StreamingSOC_hangar_mdm_int_001] [2000000123] -> Entity [{ship()}] [1234] -- m_openDoors[0], m_managerGEID[200000000001], m_ownerGEID[{player}] [Team_CGP3][Interior]\n"
+    if kind == "ship_destruction":
+        return f"{stamp(rnd, clock)} [Notice] <Vehicle Destruction> CVehicle::OnAdvanceDestroyLevel: Vehicle '{ship()}' [1725883130384] in zone 'Stanton' [pos x: 1.0, y: 2.0, z: 3.0 vel x: 0, y: 0, z: 0] driven by '{other}' [200000000002] advanced from destroy level 0 to 1 caused by '{player}' [200000000001] with 'Combat' [Team_VehicleFeatures][Vehicle]\n"
+    if kind == "connection":
+        return f"{stamp(rnd, clock)} [Notice] <Expect Incoming Connection> map=\"megamap\" gamerules=\"SC_Default\" remoteAddr=10.0.0.1:64090 localAddr=10.0.0.2:64090 connection={{1, 2}} session=bench{i} node_id=node-1 nickname=\"{player}\" playerGEID=200000000001 uptime_secs=4.2 [Team_GameServices][Login]\n"
+    return f"{stamp(rnd, clock)} [Notice] <{rnd.choice(NOISE_TAGS)}> lorem ipsum dolor sit amet {rnd.randrange(10**9)} consectetur adipiscing elit sed do eiusmod [Team_Misc][Tag]\n"
+
+def generate_log(path, lines, seed=1, player=PLAYER, mix=LINE_MIX):
+    rnd = random.Random(seed)
+    names = [f"Pilot{i}" for i in range(50)]
+    clock = time.mktime((2024, 9, 9, 12, 0, 0, 0, 0, -1))
+    kinds, bounds = mix_bounds(mix)
+
+    # Game.log is written with Windows line endings
+    with open(path, "w", newline="\r\n") as f:
+        f.write(login_line(rnd, clock, player))
+        for i in range(lines):
+            clock += rnd.randrange(50, 400) / 1000
+            f.write(log_line(rnd, clock, player, names, pick_kind(rnd, kinds, bounds), i))
+
+def connect(args):
+    # sc_command reads REDIS_URL when it first connects, so it is set before that
+    os.environ["APPDATA"] = tempfile.mkdtemp(prefix="picologs-bench-")
+    if args.fake:
+        try:
+            import fakeredis
+        except ImportError:
+            print("Error: --fake needs fakeredis (pip install fakeredis)")
+            sys.exit(1)
+        import redis
+        server = fakeredis.FakeServer()
+        redis.Redis.from_url = staticmethod(lambda url, **kwargs: fakeredis.FakeRedis(server=server))
+    else:
+        os.environ["REDIS_URL"] = args.redis
+    import sc_command
+    return sc_command
+
+class CommandCounter:
+    # Counts every command sent to Redis, pipelined or not
+    def __init__(self):
+        import redis
+        self.count = 0
+        counter = self
+        execute_command = redis.Redis.execute_command
+        pipeline_execute = redis.client.Pipeline.execute
+
+        def count_command(client, *args, **kwargs):
+            counter.count += 1
+            return execute_command(client, *args, **kwargs)
+
+        def count_pipeline(pipe, *args, **kwargs):
+            # MULTI and EXEC are sent around a transaction
+            counter.count += len(pipe.command_stack) + (2 if pipe.transaction else 0)
+            return pipeline_execute(pipe, *args, **kwargs)
+
+        redis.Redis.execute_command = count_command
+        redis.client.Pipeline.execute = count_pipeline
+
+class CountingSink:
+    def __init__(self):
+        self.ops = 0
+        self.events = 0
+
+    def write(self, ops):
+        self.ops += len(ops)
+        self.events += sum(1 for kind, item in ops if kind == "event")
+
+def parse_log(sc, path, sink):
+    watcher = sc.FileWatcher(path, buffer=sc.EventBuffer(sink), player_name=PLAYER)
+    try:
+        for block in watcher.read_blocks():
+            watcher.process_block(block)
+    finally:
+        watcher.close()
+    watcher.buffer.flush()
+
+def bench_parse(sc, path, lines):
+    sink = CountingSink()
+    started = time.perf_counter()
+    parse_log(sc, path, sink)
+    elapsed = time.perf_counter() - started
+
+    # A second pass under tracemalloc, which would skew the timing above
+    tracemalloc.start()
+    parse_log(sc, path, CountingSink())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "seconds": round(elapsed, 3),
+        "lines": lines,
+        "events": sink.events,
+        "ops": sink.ops,
+        "lines_per_second": round(lines / elapsed),
+        "events_per_second": round(sink.events / elapsed),
+        "peak_memory_bytes": peak,
+    }
+
+def bench_publish(sc, counter, ops, layout):
+    sc.get_redis().flushdb()
+    publisher = sc.create_publisher(layout, notifications=False)
+    events = sum(1 for kind, item in ops if kind == "event")
+    counter.count = 0
+    started = time.perf_counter()
+    for i in range(0, len(ops), sc.SPOOL_BATCH_SIZE):
+        publisher.write(ops[i:i + sc.SPOOL_BATCH_SIZE])
+    elapsed = time.perf_counter() - started
+    commands = counter.count
+    return {
+        "seconds": round(elapsed, 3),
+        "events": events,
+        "ops": len(ops),
+        "events_per_second": round(events / elapsed),
+        "commands": commands,
+        "commands_per_event": round(commands / events, 4),
+        "redis_memory_bytes": used_memory(sc),
+    }
+
+def used_memory(sc):
+    # The fake Redis has no INFO
+    try:
+        return sc.get_redis().info("memory").get("used_memory")
+    except Exception:
+        return None
+
+def compare(results, baseline):
+    # Prints the change of every numeric result against an earlier run
+    for section, values in results["results"].items():
+        old_values = baseline["results"].get(section, {})
+        for name, value in values.items():
+            old = old_values.get(name)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                print(f"{section}.{name}: {old} -> {value} ({(value - old) / old * 100:+.1f}%)", file=sys.stderr)
+
+def run(sc, args, layouts):
+    counter = CommandCounter()
+
+    path = args.log
+    if path is None:
+        path = os.path.join(os.environ["APPDATA"], "Game.log")
+        generate_log(path, args.lines, args.seed)
+    with open(path, "rb") as f:
+        lines = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1024 * 1024), b""))
+
+    results = {"parse": bench_parse(sc, path, lines)}
+    collector = sc.OpCollector()
+    parse_log(sc, path, collector)
+    for name in layouts:
+        results[f"publish_{name}"] = bench_publish(sc, counter, collector.ops, LAYOUTS[name])
+
+    return {
+        "version": sc.VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "redis": "fake" if args.fake else args.redis,
+        "log": args.log or {"lines": args.lines, "seed": args.seed},
+        "log_bytes": os.path.getsize(path),
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Picologs parse and Redis write benchmark")
+    parser.add_argument("--lines", type=int, default=DEFAULT_LINES, help="lines in the generated Game.log")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log", help="benchmark this Game.log instead of a generated one")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--redis", default=DEFAULT_REDIS_URL, help="Redis to write to, its database is flushed")
+    target.add_argument("--fake", action="store_true", help="use an in-process fake Redis")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS), help="storage layouts to write, comma separated")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+    layouts = [name for name in args.layouts.split(",") if name]
+    for name in layouts:
+        if name not in LAYOUTS:
+            parser.error(f"unknown layout {name}, choose from {', '.join(LAYOUTS)}")
+
+    sc = connect(args)
+    try:
+        report = run(sc, args, layouts)
+    finally:
+        shutil.rmtree(os.environ["APPDATA"], ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
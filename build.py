@@ -9,6 +9,8 @@ load_dotenv()
 # Get Redis URL from .env file
 redis_url = os.getenv('REDIS_URL')
 version = os.getenv('VERSION')
+# Set REDIS_CLUSTER=1 when REDIS_URL points at a Redis Cluster node
+redis_cluster = os.getenv('REDIS_CLUSTER', '0')
 print(f"Got Redis URL from .env: {redis_url}")
 print(f"Got Version from .env: {version}")
 
@@ -30,6 +32,7 @@ with open('sc_command.py', 'r') as f:
 print("Replacing placeholders...")
 content = content.replace('"REPLACE_WITH_REDIS_URL"', f'"{redis_url}"')
 content = content.replace('"REPLACE_WITH_VERSION"', f'"{version}"')
+content = content.replace('"REPLACE_WITH_REDIS_CLUSTER"', f'"{redis_cluster}"')
 
 # Write the modified content to a temporary file
 print("Writing temporary build file...")
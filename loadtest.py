@@ -0,0 +1,462 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import threading
+import time
+
+import bench
+
+# Replays Game.logs from many clients at once through the tracker's own
+# tailing, parsing and Redis write path, and reports throughput, write
+# latency, Redis CPU and memory, and the keys the clients contend for.
+#
+#   python loadtest.py --scenario org-op --redis redis://localhost:6379/15
+#   python loadtest.py --scenario location-burst --layout sharded --processes 8
+#   python loadtest.py --scenario my-op.json --log Game.log --output run.json
+#   python loadtest.py --scenario smoke --fake
+#
+# Like bench.py the Redis database is flushed first, so point it at a scratch
+# database of a local redis-server with RedisJSON loaded (redis-stack-server)
+
+TICK = 0.25  # Seconds between reads of each client's log, the tracker's read cap
+SAMPLE_INTERVAL = 1  # Seconds between Redis INFO samples
+START_DELAY = 3  # Seconds for the worker processes to start before the first phase
+TOP_KEYS = 10
+TOP_COMMANDS = 5
+
+# A scenario is a list of phases played one after another. Each phase sets how
+# fast every client writes log lines and can change how many clients are
+# active, the mix of lines and the locations they are at. "ramp" lets the
+# clients join one by one over the phase. "config" holds config.json settings
+# for every client and "teams" spreads the clients over that many teams
+SCENARIOS = {
+    "smoke": {
+        "clients": 10,
+        "phases": [{"name": "run", "seconds": 10, "lines_per_second": 20}],
+    },
+    "org-op": {
+        # A large org op in one team: everyone joins over a minute, then a
+        # long stretch of flying, fighting and dying
+        "clients": 300,
+        "teams": 1,
+        "phases": [
+            {"name": "join", "seconds": 60, "lines_per_second": 10, "ramp": True},
+            {"name": "op", "seconds": 600, "lines_per_second": 20},
+        ],
+    },
+    "location-burst": {
+        # Everyone waits at one station until a fight breaks out there
+        "clients": 200,
+        "phases": [
+            {"name": "calm", "seconds": 30, "lines_per_second": 10},
+            {"name": "burst", "seconds": 30, "lines_per_second": 100, "locations": ["Stanton2_Orison"],
+             "mix": {"location": 0.3, "nearby_death": 0.2, "own_death": 0.05, "ship_destruction": 0.05}},
+            {"name": "after", "seconds": 30, "lines_per_second": 10},
+        ],
+    },
+}
+
+def load_scenario(name):
+    if name in SCENARIOS:
+        return dict(SCENARIOS[name], name=name)
+    with open(name) as f:
+        scenario = json.load(f)
+    scenario.setdefault("name", os.path.splitext(os.path.basename(name))[0])
+    return scenario
+
+def client_name(number):
+    return f"LoadPilot{number}"
+
+def percentile(values, share):
+    # Nearest rank of sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+class KeyCounter:
+    # Counts the commands sent per key, and which clients sent them, from
+    # every pipeline. The tracker only writes through pipelines
+    def __init__(self):
+        import redis
+        self.keys = {}  # Key -> [commands, set of client numbers]
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Client number of the thread
+        counter = self
+        pipeline_execute = redis.client.Pipeline.execute
+
+        def count_pipeline(pipe, *args, **kwargs):
+            client = getattr(counter.local, "client", None)
+            with counter.lock:
+                for command_args, _ in pipe.command_stack:
+                    if len(command_args) < 2:
+                        continue
+                    key = command_args[1]
+                    key = key.decode() if isinstance(key, bytes) else str(key)
+                    entry = counter.keys.setdefault(key, [0, set()])
+                    entry[0] += 1
+                    entry[1].add(client)
+            return pipeline_execute(pipe, *args, **kwargs)
+
+        redis.client.Pipeline.execute = count_pipeline
+
+class ClientStats:
+    def __init__(self, phases):
+        self.phase = 0
+        self.latencies = [[] for _ in range(phases)]  # Seconds per write, by phase
+        self.events = [0] * phases
+        self.ops = [0] * phases
+        self.lines = [0] * phases
+        self.errors = 0
+
+class TimedSink:
+    # EventBuffer sink timing each write to Redis
+    def __init__(self, publisher, stats):
+        self.publisher = publisher
+        self.stats = stats
+
+    def write(self, ops):
+        started = time.perf_counter()
+        try:
+            self.publisher.write(ops)
+        except Exception:
+            self.stats.errors += 1
+            raise
+        phase = self.stats.phase
+        self.stats.latencies[phase].append(time.perf_counter() - started)
+        self.stats.events[phase] += sum(1 for kind, item in ops if kind == "event")
+        self.stats.ops[phase] += len(ops)
+
+class LineSource:
+    # Log lines for one client, generated like bench.py does or taken in
+    # turn from a recorded Game.log with its player renamed to the client
+    def __init__(self, number, names, seed, recorded=None, recorded_player=None):
+        self.player = client_name(number)
+        self.names = names
+        self.rnd = random.Random(seed * 100003 + number)
+        self.count = 0
+        self.recorded = None
+        if recorded:
+            lines = recorded if recorded_player is None else [line.replace(recorded_player, self.player) for line in recorded]
+            # Clients start at different points of the log
+            start = self.rnd.randrange(len(lines))
+            self.recorded = lines[start:] + lines[:start]
+
+    def first_line(self):
+        return bench.login_line(self.rnd, time.time(), self.player)
+
+    def lines(self, count, phase):
+        if self.recorded:
+            for _ in range(count):
+                yield self.recorded[self.count % len(self.recorded)]
+                self.count += 1
+            return
+        kinds, bounds = bench.mix_bounds(phase.get("mix", bench.LINE_MIX))
+        locations = phase.get("locations", bench.LOCATIONS)
+        now = time.time()
+        for _ in range(count):
+            kind = bench.pick_kind(self.rnd, kinds, bounds)
+            yield bench.log_line(self.rnd, now, self.player, self.names, kind, self.count, locations)
+            self.count += 1
+
+def run_client(sc, number, scenario, start, source, counter, stats):
+    clients = scenario["clients"]
+    config = dict(scenario.get("config", {}))
+    if scenario.get("teams"):
+        config["team"] = f"LoadTeam{number % scenario['teams']}"
+    counter.local.client = number
+    path = os.path.join(os.environ["APPDATA"], f"{source.player}.log")
+    with open(path, "w", newline="\r\n") as f:
+        f.write(source.first_line())
+    buffer = sc.EventBuffer(TimedSink(sc.create_publisher(config), stats), coalescer=sc.create_coalescer(config))
+    watcher = sc.FileWatcher(path, buffer=buffer, player_name=source.player)
+
+    # Clients read at their own moments within a tick, like separate machines
+    offset = source.rnd.random() * TICK
+    begins = start
+    for index, phase in enumerate(scenario["phases"]):
+        stats.phase = index
+        ends = begins + phase["seconds"]
+        joins = begins + (phase["seconds"] * number / clients if phase.get("ramp") else 0)
+        active = number < phase.get("clients", clients)
+        owed = 0.0
+        last = max(begins, joins)
+        tick = begins + offset
+        while tick < ends:
+            time.sleep(max(0, tick - time.time()))
+            now = min(time.time(), ends)
+            if active and now >= joins:
+                # Lines owed for the time passed, so a client running late
+                # catches up, but never with lines of the next phase
+                owed += phase["lines_per_second"] * (now - last)
+                last = now
+                lines = int(owed)
+                owed -= lines
+                if lines:
+                    with open(path, "a", newline="\r\n") as f:
+                        f.writelines(source.lines(lines, phase))
+                    stats.lines[index] += lines
+                watcher.check_file()
+            tick += TICK
+        begins = ends
+    watcher.buffer.flush(final=True)
+    watcher.close()
+
+def run_clients(sc, scenario, numbers, start, seed, log=None):
+    # Runs clients as threads of this process, returns their merged results
+    os.makedirs(os.path.dirname(sc.CHECKPOINT_FILE), exist_ok=True)
+    counter = KeyCounter()
+    phases = len(scenario["phases"])
+    names = [client_name(number) for number in range(scenario["clients"])]
+    recorded = recorded_player = None
+    if log:
+        recorded_player = sc.find_player_name(log)
+        with open(log, encoding="utf-8", errors="replace", newline="") as f:
+            recorded = [line for line in f if line.strip()]
+
+    threads = []
+    stats = []
+    for number in numbers:
+        source = LineSource(number, names, seed, recorded, recorded_player)
+        client_stats = ClientStats(phases)
+        thread = threading.Thread(target=run_client, args=(sc, number, scenario, start, source, counter, client_stats), daemon=True)
+        thread.start()
+        threads.append(thread)
+        stats.append(client_stats)
+    for thread in threads:
+        thread.join()
+
+    return {
+        "latencies": [[value for client in stats for value in client.latencies[i]] for i in range(phases)],
+        "events": [sum(client.events[i] for client in stats) for i in range(phases)],
+        "ops": [sum(client.ops[i] for client in stats) for i in range(phases)],
+        "lines": [sum(client.lines[i] for client in stats) for i in range(phases)],
+        "errors": sum(client.errors for client in stats),
+        "keys": {key: [commands, sorted(client for client in clients if client is not None)]
+                 for key, (commands, clients) in counter.keys.items()},
+    }
+
+def worker(fake, redis_url, scenario, numbers, start, seed, log):
+    # Runs in a spawned process, each with its own APPDATA and Redis pool
+    sc = bench.connect(argparse.Namespace(fake=fake, redis=redis_url))
+    try:
+        return run_clients(sc, scenario, numbers, start, seed, log)
+    finally:
+        shutil.rmtree(os.environ["APPDATA"], ignore_errors=True)
+
+class RedisSampler(threading.Thread):
+    # Samples CPU time and memory use of the Redis server while clients run
+    def __init__(self, client):
+        super().__init__(daemon=True)
+        self.client = client
+        self.samples = []  # (time, CPU seconds, used memory)
+        self.stopped = threading.Event()
+
+    def sample(self):
+        try:
+            info = self.client.info()
+        except Exception:
+            return  # The fake Redis has no INFO
+        self.samples.append((time.time(), info["used_cpu_sys"] + info["used_cpu_user"], info["used_memory"]))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(SAMPLE_INTERVAL)
+        self.sample()
+
+def command_stats(client):
+    try:
+        return client.info("commandstats")
+    except Exception:
+        return {}
+
+def merge(parts):
+    merged = {name: [sum(values) for values in zip(*(part[name] for part in parts))] for name in ("events", "ops", "lines")}
+    merged["latencies"] = [sorted(value for part in parts for value in part["latencies"][i]) for i in range(len(parts[0]["events"]))]
+    merged["errors"] = sum(part["errors"] for part in parts)
+    keys = {}
+    for part in parts:
+        for key, (commands, clients) in part["keys"].items():
+            entry = keys.setdefault(key, [0, set()])
+            entry[0] += commands
+            entry[1].update(clients)
+    merged["keys"] = keys
+    return merged
+
+def latency_summary(latencies):
+    return {
+        "p50": round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        "p90": round(percentile(latencies, 0.9) * 1000, 2) if latencies else None,
+        "p99": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "max": round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+def redis_summary(samples, events):
+    if len(samples) < 2:
+        return {}
+    (first_time, first_cpu, first_memory), (last_time, last_cpu, last_memory) = samples[0], samples[-1]
+    busy = [(cpu - previous_cpu) / (now - previous_time) * 100
+            for (previous_time, previous_cpu, _), (now, cpu, _) in zip(samples, samples[1:]) if now > previous_time]
+    return {
+        "cpu_percent_avg": round((last_cpu - first_cpu) / (last_time - first_time) * 100, 1),
+        "cpu_percent_max": round(max(busy), 1),
+        "used_memory_start": first_memory,
+        "used_memory_end": last_memory,
+        "used_memory_peak": max(memory for _, _, memory in samples),
+        "memory_growth_bytes": last_memory - first_memory,
+        "memory_per_event_bytes": round((last_memory - first_memory) / events, 1) if events else None,
+    }
+
+def top_commands(before, after):
+    # Commands that took the most Redis time during the run
+    spent = []
+    for name, stats in after.items():
+        old = before.get(name, {})
+        calls = stats["calls"] - old.get("calls", 0)
+        usec = stats["usec"] - old.get("usec", 0)
+        if calls:
+            spent.append({"command": name.replace("cmdstat_", ""), "calls": calls, "usec": usec, "usec_per_call": round(usec / calls, 2)})
+    spent.sort(key=lambda command: command["usec"], reverse=True)
+    return spent[:TOP_COMMANDS]
+
+def report(scenario, merged, samples, elapsed, before, after):
+    commands = sum(commands for commands, _ in merged["keys"].values())
+    hot = sorted(merged["keys"].items(), key=lambda item: item[1][0], reverse=True)
+    events = sum(merged["events"])
+    latencies = sorted(value for phase in merged["latencies"] for value in phase)
+    phases = []
+    for i, phase in enumerate(scenario["phases"]):
+        phases.append(dict({
+            "name": phase.get("name", str(i)),
+            "seconds": phase["seconds"],
+            "events": merged["events"][i],
+            "events_per_second": round(merged["events"][i] / phase["seconds"]),
+            "lines_per_second": round(merged["lines"][i] / phase["seconds"]),
+        }, **{f"latency_{name}_ms": value for name, value in latency_summary(merged["latencies"][i]).items()}))
+    return {
+        "results": {
+            "totals": {
+                "seconds": round(elapsed, 1),
+                "lines": sum(merged["lines"]),
+                "events": events,
+                "ops": sum(merged["ops"]),
+                "writes": len(latencies),
+                "write_errors": merged["errors"],
+                "events_per_second": round(events / elapsed),
+            },
+            "latency_ms": latency_summary(latencies),
+            "redis": redis_summary(samples, events),
+            "contention": {
+                "keys": len(merged["keys"]),
+                "top_key_share": round(hot[0][1][0] / commands, 3) if hot else None,
+                "max_clients_per_key": max((len(clients) for _, clients in merged["keys"].values()), default=0),
+            },
+        },
+        "phases": phases,
+        "hot_keys": [{"key": key, "commands": count, "share": round(count / commands, 3), "clients": len(clients)}
+                     for key, (count, clients) in hot[:TOP_KEYS]],
+        "redis_commands": top_commands(before, after),
+    }
+
+def print_summary(result):
+    totals = result["results"]["totals"]
+    latency = result["results"]["latency_ms"]
+    print(f"{totals['events']} events in {totals['seconds']}s, {totals['events_per_second']} events/s, "
+          f"write latency p50 {latency['p50']} ms p99 {latency['p99']} ms, {totals['write_errors']} failed writes", file=sys.stderr)
+    for phase in result["phases"]:
+        print(f"  {phase['name']}: {phase['events_per_second']} events/s, p50 {phase['latency_p50_ms']} ms p99 {phase['latency_p99_ms']} ms", file=sys.stderr)
+    redis_stats = result["results"]["redis"]
+    if redis_stats:
+        print(f"Redis CPU {redis_stats['cpu_percent_avg']}% average, {redis_stats['cpu_percent_max']}% peak, "
+              f"memory +{redis_stats['memory_growth_bytes']} bytes", file=sys.stderr)
+    for key in result["hot_keys"][:5]:
+        print(f"  {key['key']}: {key['share'] * 100:.1f}% of commands from {key['clients']} clients", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Picologs multi-client Redis load test")
+    parser.add_argument("--scenario", default="smoke", help=f"{', '.join(SCENARIOS)} or a scenario JSON file")
+    parser.add_argument("--clients", type=int, help="number of clients, instead of the scenario's")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="processes the clients are spread over")
+    parser.add_argument("--layout", default="json", help=f"storage layout from bench.py: {', '.join(bench.LAYOUTS)}")
+    parser.add_argument("--log", help="replay this recorded Game.log instead of generated lines")
+    parser.add_argument("--seed", type=int, default=1)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--redis", default=bench.DEFAULT_REDIS_URL, help="Redis to write to, its database is flushed")
+    target.add_argument("--fake", action="store_true", help="use an in-process fake Redis, clients run in one process")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+    if args.layout not in bench.LAYOUTS:
+        parser.error(f"unknown layout {args.layout}, choose from {', '.join(bench.LAYOUTS)}")
+    try:
+        scenario = load_scenario(args.scenario)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot load scenario {args.scenario}: {e}")
+    if args.clients:
+        scenario["clients"] = args.clients
+    # Scenario settings win over the layout's
+    scenario["config"] = dict(bench.LAYOUTS[args.layout], **scenario.get("config", {}))
+
+    clients = list(range(scenario["clients"]))
+    processes = 1 if args.fake else max(1, min(args.processes, len(clients)))
+    if args.fake:
+        sc = bench.connect(args)
+        control = sc.get_redis()
+    else:
+        import redis
+        control = redis.Redis.from_url(args.redis)
+    control.flushdb()
+
+    before = command_stats(control)
+    sampler = RedisSampler(control)
+    start = time.time() + START_DELAY
+    try:
+        if args.fake:
+            sampler.start()
+            parts = [run_clients(sc, scenario, clients, start, args.seed, args.log)]
+        else:
+            import multiprocessing
+            # Spawned, so no worker shares a connection with this process
+            with multiprocessing.get_context("spawn").Pool(processes) as pool:
+                pending = pool.starmap_async(worker, [(False, args.redis, scenario, clients[i::processes], start, args.seed, args.log)
+                                                      for i in range(processes)])
+                sampler.start()
+                parts = pending.get()
+    finally:
+        sampler.stopped.set()
+        if sampler.is_alive():
+            sampler.join()
+        if args.fake:
+            shutil.rmtree(os.environ["APPDATA"], ignore_errors=True)
+    elapsed = time.time() - start
+    after = command_stats(control)
+
+    result = report(scenario, merge(parts), [sample for sample in sampler.samples if sample[0] >= start], elapsed, before, after)
+    result = dict({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "redis": "fake" if args.fake else args.redis,
+        "scenario": scenario,
+        "layout": args.layout,
+        "processes": processes,
+        "log": args.log,
+    }, **result)
+    print_summary(result)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            bench.compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,23 @@
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import time
 import os
 import json
-import datetime
+import calendar
+import hashlib
+import re
 import sys
-import redis
-import webbrowser
-from dotenv import load_dotenv
-from win32com.client import Dispatch
-import tkinter as tk
-from tkinter import filedialog
-import winreg
+import queue
+import argparse
+import threading
+import bisect
+
+# Only what tailing and parsing need is imported up front. Redis, the Windows
+# and GUI modules and anything used by a single command are imported where
+# they are used, so the exe starts reading Game.log sooner and the engine
+# can be imported on any platform
 
 def find_star_citizen_path():
+    import winreg
     reg_paths = [
         (winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall"),
         (winreg.HKEY_CURRENT_USER, r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall"),
@@ -59,21 +63,22 @@ def find_star_citizen_path():
     return "Star Citizen not found in registry or common locations."
 
 
-# Load environment variables from .env file if it exists
-load_dotenv()
-
 VERSION = "alpha-0.0.24"
 
 # Debug flag for testing file selection dialog
 DEBUG_FORCE_FILE_SELECT = False  # Set to True to force file selection dialog
 
 # Get the AppData path for configuration
-APP_DATA_PATH = os.path.join(os.getenv('APPDATA'), 'picologs')
+APP_DATA_PATH = os.path.join(os.getenv('APPDATA') or os.path.join(os.path.expanduser('~'), '.config'), 'picologs')
 CONFIG_FILE = os.path.join(APP_DATA_PATH, 'config.json')
+CHECKPOINT_FILE = os.path.join(APP_DATA_PATH, 'checkpoint.json')
+TAILED_FILE = os.path.join(APP_DATA_PATH, 'tailed.json')
 
 # Redis URL - This will be replaced during build process
-# For development, it will use the environment variable
-REDIS_URL = os.getenv('REDIS_URL', "REPLACE_WITH_REDIS_URL")
+# For development, it will use the environment variable or the .env file
+REDIS_URL = "REPLACE_WITH_REDIS_URL"
+# Set to 1 when REDIS_URL points at a Redis Cluster node, also replaced during build
+REDIS_CLUSTER = "REPLACE_WITH_REDIS_CLUSTER"
 
 def load_or_create_config():
     # Create AppData directory if it doesn't exist
@@ -105,6 +110,43 @@ def save_config(config):
     with open(CONFIG_FILE, 'w') as f:
         json.dump(config, f, indent=4)
 
+# The checkpoint records how far each Game.log has been read, keyed by its path
+def load_checkpoints():
+    try:
+        with open(CHECKPOINT_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return {}
+
+# Watchers of several logs share one checkpoint dict and may save it from different threads
+checkpoint_lock = threading.Lock()
+
+def save_checkpoints(checkpoints):
+    # Written to a temporary file first so a crash never leaves a half-written checkpoint
+    temp_file = CHECKPOINT_FILE + '.tmp'
+    with checkpoint_lock:
+        with open(temp_file, 'w') as f:
+            json.dump(checkpoints, f)
+        os.replace(temp_file, CHECKPOINT_FILE)
+
+# Every log read live is listed by fingerprint with the offset tailing started
+# from, so backfill only loads the part of it written before
+def load_tailed_logs():
+    try:
+        with open(TAILED_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return []
+
+def record_tailed_log(fingerprint, start):
+    with checkpoint_lock:
+        logs = [log for log in load_tailed_logs() if log["head"] != fingerprint["head"]]
+        logs.append({"head_size": fingerprint["head_size"], "head": fingerprint["head"], "start": start})
+        temp_file = TAILED_FILE + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(logs, f)
+        os.replace(temp_file, TAILED_FILE)
+
 def prompt_for_config():
     config = load_or_create_config()
     
@@ -235,6 +277,7 @@ def prompt_for_config():
                             continue
                     
                     try:
+                        from win32com.client import Dispatch
                         shell = Dispatch('WScript.Shell')
                         shortcut = shell.CreateShortCut(shortcut_path)
                         shortcut.Targetpath = batch_path
@@ -279,25 +322,1606 @@ def prompt_for_config():
     
     return config
 
-# Ensure URL has the correct scheme
-if not REDIS_URL.startswith(('redis://', 'rediss://')):
-    REDIS_URL = 'redis://' + REDIS_URL
+# The client is created on first use and connects when the first command is
+# sent, so tailing starts without waiting for the network. The spool sender
+# makes the first connection in the background and retries with backoff
+REDIS_CONNECT_TIMEOUT = 5  # Seconds before a connection attempt is given up
+_redis_client = None
+_redis_lock = threading.Lock()
+
+CLUSTER_REDIRECTS = 5  # Times a transaction is resent after its slot moved to another node
+
+def redis_settings():
+    from dotenv import load_dotenv
+    # Load environment variables from .env file if it exists
+    load_dotenv()
+    url = os.getenv('REDIS_URL', REDIS_URL)
+    # Ensure URL has the correct scheme
+    if not url.startswith(('redis://', 'rediss://')):
+        url = 'redis://' + url
+    cluster = os.getenv('REDIS_CLUSTER', REDIS_CLUSTER).lower() in ("1", "true", "yes")
+    return url, cluster
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                import redis
+                url, cluster = redis_settings()
+                if cluster:
+                    # Learns the slot map from the node in the URL, keeps a
+                    # connection pool per node and follows MOVED and ASK replies
+                    _redis_client = redis.RedisCluster.from_url(url, socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+                else:
+                    _redis_client = redis.Redis.from_url(url, socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+    return _redis_client
+
+def shard_pipeline(shard=None):
+    # A transaction for the keys of one shard. On a cluster it is sent to the
+    # node serving the shard's slot, which works because all its keys share a tag
+    client = get_redis()
+    if shard is None or not hasattr(client, "get_node_from_key"):
+        return client.pipeline()
+    node = client.get_node_from_key(shard_key("", shard))
+    return client.get_redis_connection(node).pipeline()
+
+def is_cluster_redirect(error):
+    import redis
+    return isinstance(error, (redis.exceptions.MovedError, redis.exceptions.AskError, redis.exceptions.TryAgainError))
+
+def is_aborted_write(error):
+    # Redis refused the transaction while it was queued, e.g. at maxmemory or
+    # on a replica after a failover, so none of it was applied
+    import redis
+    return isinstance(error, (redis.exceptions.ExecAbortError, redis.exceptions.OutOfMemoryError, redis.exceptions.ReadOnlyError))
+
+def refresh_cluster_slots():
+    client = get_redis()
+    if hasattr(client, "nodes_manager"):
+        client.nodes_manager.initialize()
+
+def check_redis():
+    # For commands that cannot do anything without Redis
+    try:
+        get_redis().ping()
+        return True
+    except Exception as e:
+        print(f"Error connecting to Redis: {str(e)}")
+        return False
+
+# Counters and histograms for the running process, printed as a periodic
+# stats line and served in Prometheus text format when metrics_port is set.
+# Updates are plain dict and list increments so the read loop barely notices
+STATS_INTERVAL = 60  # Seconds between stats lines
+REDIS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PUBLISH_LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+COUNTER_LABELS = {"events": "type", "parse_failures": "rule", "writes_saved": "reason"}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}  # (name, label) -> count
+        self.histograms = {
+            "redis_write_seconds": Histogram(REDIS_LATENCY_BUCKETS),
+            "publish_lag_seconds": Histogram(PUBLISH_LAG_BUCKETS)
+        }
+        self.gauges = {}  # name -> function returning the current value
+
+    def inc(self, name, label=None, amount=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def total(self, name):
+        return sum(count for (counter, label), count in list(self.counters.items()) if counter == name)
+
+    def prometheus(self):
+        counters = sorted(self.counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+        lines = []
+        last_name = None
+        for (name, label), count in counters:
+            if name != last_name:
+                lines.append(f"# TYPE picologs_{name}_total counter")
+                last_name = name
+            labels = f'{{{COUNTER_LABELS[name]}="{label}"}}' if label is not None else ""
+            lines.append(f"picologs_{name}_total{labels} {count}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE picologs_{name} gauge")
+            lines.append(f"picologs_{name} {read()}")
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f"# TYPE picologs_{name} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'picologs_{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"picologs_{name}_sum {histogram.sum}")
+            lines.append(f"picologs_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        events = ", ".join(f"{label} {count}" for (name, label), count in sorted(
+            (key, count) for key, count in list(self.counters.items()) if key[0] == "events"))
+        write = self.histograms["redis_write_seconds"]
+        lag = self.histograms["publish_lag_seconds"]
+        return (f"Stats: {self.total('lines_read')} lines, {self.total('bytes_read') / 1048576:.1f} MB read, "
+                f"{self.total('events')} events ({events or 'none'}), "
+                f"{self.total('writes_saved')} writes saved, "
+                f"{self.total('parse_failures')} parse failures, {self.total('redis_write_errors')} Redis errors, "
+                f"Redis write avg {write.sum / max(write.count, 1) * 1000:.0f} ms max {write.max * 1000:.0f} ms, "
+                f"lag avg {lag.sum / max(lag.count, 1):.1f} s max {lag.max:.1f} s")
+
+metrics = Metrics()
+
+def start_metrics_server(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Every scrape would otherwise be printed to the console
+
+    # Only listens locally, the metrics include player names
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://127.0.0.1:{port}/metrics")
+    return server
+
+def observe_publish_lag(events):
+    now = time.time()
+    for event in events:
+        written = line_time(event["metadata"]["line"]) if event.get("metadata") else None
+        if written is not None:
+            metrics.observe("publish_lag_seconds", max(now - written, 0))
+
+# The global key layout has every client write to the same few keys. In the
+# sharded layout each team, or each player without a team, gets its own keys
+# with its name as a hash tag, e.g. events:{Crew} and fleet:ship:{Crew}:123.
+# Redis Cluster puts keys with the same tag in one slot, so the writes of one
+# team are still a single transaction while teams spread over all the nodes
+def shard_key(key, shard=None):
+    return key if shard is None else f"{key}:{{{shard}}}"
+
+def key_shard(key):
+    # The shard in a sharded key name, None for a global key
+    start = key.find("{")
+    end = key.find("}", start + 1)
+    return key[start + 1:end] if start != -1 and end != -1 else None
+
+STREAM_MAX_LENGTH = 10000  # Approximate number of events kept in each stream
+
+class JsonEventStore:
+    # Legacy layout: every client appends to the one "events" JSON array.
+    # Compact events go to their own array so the two formats never mix
+    def __init__(self, encoder=None):
+        self.encoder = encoder
+        self.key = "events:v1" if encoder else "events"
+        self.ready_keys = set()
+
+    def write(self, pipe, events, shard=None):
+        doc = pipe.json()
+        key = shard_key(self.key, shard)
+        if key not in self.ready_keys:
+            doc.set(key, "$", [], nx=True)
+            self.ready_keys.add(key)
+        doc.arrappend(key, "$", *(self.encoder.encode(events) if self.encoder else events))
+
+    def reset(self):
+        # The keys may have been removed server side, so create them again next time
+        self.ready_keys.clear()
+
+class StreamEventStore:
+    # One capped Redis Stream per team, or per player when no team is set.
+    # Consumers read new entries by ID instead of fetching a whole array
+    def __init__(self, team=None, encoder=None, max_length=STREAM_MAX_LENGTH):
+        self.team = team
+        self.encoder = encoder
+        self.max_length = max_length
+
+    def stream_key(self, event, shard=None):
+        if shard is not None:
+            return shard_key("events", shard)
+        return f"events:{self.team or event['player']}"
+
+    def write(self, pipe, events, shard=None):
+        if self.encoder:
+            entries = [{"e": json.dumps(payload, separators=(",", ":"))} for payload in self.encoder.encode(events)]
+        else:
+            entries = [encode_stream_event(event) for event in events]
+        for event, fields in zip(events, entries):
+            pipe.xadd(self.stream_key(event, shard), fields, maxlen=self.max_length, approximate=True)
+
+    def reset(self):
+        pass
+
+def create_event_store(config):
+    encoder = None
+    if config.get('event_format', 'legacy') == 'compact':
+        encoder = CompactEncoder(config.get('raw_lines', 'off'))
+    if config.get('storage', 'json') == 'streams':
+        return StreamEventStore(config.get('team'), encoder)
+    return JsonEventStore(encoder)
+
+def encode_stream_event(event):
+    fields = {
+        "timestamp": event["timestamp"],
+        "player": event["player"],
+        "type": event["type"],
+        "details": json.dumps(event["details"]),
+        "metadata": json.dumps(event["metadata"])
+    }
+    if "channel" in event:
+        fields["channel"] = event["channel"]
+    return fields
+
+def decode_stream_event(fields):
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    if "e" in fields:
+        # Compact entry, turned back into an event by decode_events
+        return json.loads(fields["e"])
+    event = {
+        "timestamp": fields["timestamp"],
+        "player": fields["player"],
+        "type": fields["type"],
+        "details": json.loads(fields["details"]),
+        "metadata": json.loads(fields["metadata"])
+    }
+    if "channel" in fields:
+        event["channel"] = fields["channel"]
+    return event
+
+def read_stream_events(stream_key, last_id="0-0", count=500, block=None):
+    # For consumers of the streams layout. Returns (id, event) pairs newer than
+    # last_id; pass the last id back in to carry on from there
+    events = []
+    for _, entries in get_redis().xread({stream_key: last_id}, count=count, block=block) or []:
+        for entry_id, fields in entries:
+            events.append((entry_id.decode(), decode_stream_event(fields)))
+
+    compact = [event for _, event in events if "v" in event]
+    if compact:
+        decoded = iter(decode_events(compact))
+        events = [(entry_id, next(decoded) if "v" in event else event) for entry_id, event in events]
+    return events
+
+# Compact event format: short field names, epoch timestamps and player names
+# replaced by short shared IDs. Version 1 looks like
+#   {"v": 1, "t": 1725883130, "p": "1f", "k": "k", "d": {"v": "2b", "ca": "Bullet"}}
+# with the raw log line under "l" only when raw lines are enabled
+EVENT_FORMAT_VERSION = 1
+RAW_LINE_LIMIT = 160  # Characters kept when raw lines are truncated
+
+EVENT_TYPE_CODES = {
+    "quit": "q",
+    "connection": "c",
+    "location": "l",
+    "death": "d",
+    "kill": "k",
+    "nearby_death": "nd",
+    "nearby_kill": "nk",
+    "ship_destroyed": "s"
+}
+DETAIL_KEY_CODES = {
+    "status": "s",
+    "player": "p",
+    "session": "se",
+    "player_geid": "g",
+    "location": "lo",
+    "type": "ty",
+    "killer": "kr",
+    "cause": "ca",
+    "victim": "v",
+    "ship": "sh"
+}
+SYMBOL_DETAILS = ("player", "killer", "victim")  # Details holding player names
+EVENT_TYPES = {code: name for name, code in EVENT_TYPE_CODES.items()}
+DETAIL_KEYS = {code: key for key, code in DETAIL_KEY_CODES.items()}
+
+def to_base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    text = ""
+    while True:
+        number, digit = divmod(number, 36)
+        text = digits[digit] + text
+        if not number:
+            return text
+
+class SymbolTable:
+    # Player names are swapped for short IDs handed out by Redis and shared by
+    # every client. symbols:ids maps names to IDs and symbols:names maps back
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+
+    def intern(self, names):
+        missing = list({name for name in names if name not in self.ids})
+        if not missing:
+            return
+        self.remember(missing, get_redis().hmget("symbols:ids", missing))
+        new = [name for name in missing if name not in self.ids]
+        if not new:
+            return
+
+        first = get_redis().incrby("symbols:next", len(new)) - len(new)
+        pipe = get_redis().pipeline()
+        for offset, name in enumerate(new):
+            symbol = to_base36(first + offset)
+            pipe.hsetnx("symbols:ids", name, symbol)
+            pipe.hset("symbols:names", symbol, name)
+        pipe.execute()
+        # Another client may have claimed some of the names first
+        self.remember(new, get_redis().hmget("symbols:ids", new))
+
+    def lookup(self, symbols):
+        missing = list({symbol for symbol in symbols if symbol not in self.names})
+        if missing:
+            for symbol, name in zip(missing, get_redis().hmget("symbols:names", missing)):
+                if name is not None:
+                    self.names[symbol] = name.decode()
+
+    def remember(self, names, symbols):
+        for name, symbol in zip(names, symbols):
+            if symbol is not None:
+                self.ids[name] = symbol.decode()
+                self.names[symbol.decode()] = name
+
+class CompactEncoder:
+    def __init__(self, raw_lines="off", raw_line_limit=RAW_LINE_LIMIT):
+        self.raw_lines = raw_lines  # "off", "truncate" or "full"
+        self.raw_line_limit = raw_line_limit
+        self.symbols = SymbolTable()
+
+    def encode(self, events):
+        names = []
+        for event in events:
+            names.append(event["player"])
+            names.extend(event["details"][key] for key in SYMBOL_DETAILS if key in event["details"])
+        self.symbols.intern(names)
+        return [self.encode_event(event) for event in events]
+
+    def encode_event(self, event):
+        ids = self.symbols.ids
+        payload = {
+            "v": EVENT_FORMAT_VERSION,
+            "t": calendar.timegm(time.strptime(event["timestamp"], '%Y-%m-%dT%H:%M:%SZ')),
+            "p": ids[event["player"]],
+            "k": EVENT_TYPE_CODES.get(event["type"], event["type"]),
+            "d": {
+                DETAIL_KEY_CODES.get(key, key): ids[value] if key in SYMBOL_DETAILS else value
+                for key, value in event["details"].items()
+            }
+        }
+        if "channel" in event:
+            payload["c"] = event["channel"]
+        line = (event["metadata"] or {}).get("line")
+        if line and self.raw_lines == "full":
+            payload["l"] = line
+        elif line and self.raw_lines == "truncate":
+            payload["l"] = line[:self.raw_line_limit]
+        return payload
+
+def decode_events(payloads, symbols=None):
+    # For consumers of the compact format: turns payloads back into events
+    # shaped like the legacy ones, looking up all player names in one go
+    symbols = symbols or SymbolTable()
+    needed = []
+    for payload in payloads:
+        needed.append(payload["p"])
+        needed.extend(payload["d"][DETAIL_KEY_CODES[key]] for key in SYMBOL_DETAILS if DETAIL_KEY_CODES[key] in payload["d"])
+    symbols.lookup(needed)
+    return [decode_event(payload, symbols.names) for payload in payloads]
+
+def decode_event(payload, names):
+    if payload.get("v") != EVENT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported event format version: {payload.get('v')}")
+    details = {}
+    for code, value in payload["d"].items():
+        key = DETAIL_KEYS.get(code, code)
+        details[key] = names.get(value, value) if key in SYMBOL_DETAILS else value
+    event = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(payload["t"])),
+        "player": names.get(payload["p"], payload["p"]),
+        "type": EVENT_TYPES.get(payload["k"], payload["k"]),
+        "details": details,
+        "metadata": {"line": payload["l"]} if "l" in payload else None
+    }
+    if "c" in payload:
+        event["channel"] = payload["c"]
+    return event
+
+class JsonFleetStore:
+    # Legacy layout: all ships in the one "fleet" JSON array, removed with a
+    # JSONPath filter that scans the whole array
+    key = "fleet"
+
+    def __init__(self):
+        self.ready_keys = set()
+
+    def write(self, pipe, ops, shard=None):
+        # Ship entries are grouped into one ARRAPPEND; a delete sends the
+        # entries queued before it first so ordering is kept
+        doc = pipe.json()
+        key = shard_key(self.key, shard)
+        ships = []
+        for kind, item in ops:
+            if kind == "ship":
+                ships.append(item)
+            elif kind == "ship_destroyed":
+                self.append_ships(doc, key, ships)
+                ships = []
+                doc.delete(key, f"$[?(@.id == \"{item}\")]")
+        self.append_ships(doc, key, ships)
+
+    def append_ships(self, doc, key, ships):
+        if not ships:
+            return
+        if key not in self.ready_keys:
+            doc.set(key, "$", [], nx=True)
+            self.ready_keys.add(key)
+        doc.arrappend(key, "$", *ships)
+
+    def reset(self):
+        self.ready_keys.clear()
+
+def fleet_ship_key(ship_id, shard=None):
+    return f"{shard_key('fleet:ship', shard)}:{ship_id}"
+
+def fleet_owner_key(owner, shard=None):
+    return f"{shard_key('fleet:owner', shard)}:{owner}"
+
+class HashFleetStore:
+    # One hash per ship plus a set of ship IDs per owner, so adding, updating
+    # and removing a ship are all O(1). Entering the same ship again just
+    # overwrites its hash instead of adding a duplicate entry
+    def __init__(self):
+        self.owners = {}  # Owners of the ships this client has added
+
+    def write(self, pipe, ops, shard=None):
+        for kind, item in ops:
+            if kind == "ship":
+                pipe.hset(fleet_ship_key(item["id"], shard), mapping=item)
+                pipe.sadd(fleet_owner_key(item["owner"], shard), item["id"])
+                self.owners[item["id"]] = item["owner"]
+            elif kind == "ship_destroyed":
+                pipe.delete(fleet_ship_key(item, shard))
+                # Ships added by other clients are left in their owner's index
+                # and dropped the next time get_fleet reads it
+                owner = self.owners.pop(item, None)
+                if owner:
+                    pipe.srem(fleet_owner_key(owner, shard), item)
+
+    def reset(self):
+        pass
+
+def create_fleet_store(config):
+    if config.get('fleet_storage', 'json') == 'hash':
+        return HashFleetStore()
+    return JsonFleetStore()
+
+def get_fleet(owner, shard=None):
+    # For consumers of the hash layout. Returns the owner's ships, oldest first.
+    # With the sharded layout pass the owner's team, or the owner without one
+    ship_ids = [ship_id.decode() for ship_id in get_redis().smembers(fleet_owner_key(owner, shard))]
+    pipe = shard_pipeline(shard) if shard is not None else get_redis().pipeline(transaction=False)
+    for ship_id in ship_ids:
+        pipe.hgetall(fleet_ship_key(ship_id, shard))
+
+    ships = []
+    destroyed = []
+    for ship_id, fields in zip(ship_ids, pipe.execute()):
+        if fields:
+            ships.append({key.decode(): value.decode() for key, value in fields.items()})
+        else:
+            destroyed.append(ship_id)
+    if destroyed:
+        get_redis().srem(fleet_owner_key(owner, shard), *destroyed)
+    return sorted(ships, key=lambda ship: ship["timestamp"])
+
+# Aggregates are updated in the same transaction as the events they count, so
+# dashboards read a hash or a sorted set instead of scanning every event.
+# Per player and per session there is a hash with the number of events of
+# each type, kills and deaths per damage type and the last event time
+LEADERBOARDS = {"kill": "leaderboard:kills", "death": "leaderboard:deaths"}
+AGGREGATE_PATTERNS = ("stats:*", "leaderboard:*")  # Every key rebuild_aggregates replaces
+REBUILD_BATCH_SIZE = 1000  # Stored events read and counted per round trip
+
+def player_stats_key(player, shard=None):
+    return f"{shard_key('stats:player', shard)}:{player}"
+
+def player_sessions_key(player, shard=None):
+    # Session IDs scored by their start time
+    return f"{player_stats_key(player, shard)}:sessions"
+
+def session_stats_key(session, shard=None):
+    return f"{shard_key('stats:session', shard)}:{session}"
+
+def leaderboard_key(kind, shard=None):
+    return shard_key(LEADERBOARDS[kind], shard)
+
+def event_epoch(event):
+    return calendar.timegm(time.strptime(event["timestamp"], '%Y-%m-%dT%H:%M:%SZ'))
+
+class AggregateStore:
+    def __init__(self, lookup_sessions=True, history=False, replay=False):
+        self.sessions = {}  # Current session of each player
+        # History is counted without touching the player's current session,
+        # and only sets last_seen for players not seen live yet
+        self.history = history
+        # A replay reads events in storage order, where backfilled sessions
+        # follow the live ones, so each event goes to the session running at
+        # its timestamp and only the latest session and last_seen are kept
+        self.replay = replay
+        self.starts = {}  # (player, shard) -> (start, session) pairs by start
+        self.seen = {}  # Stats key -> latest last_seen written
+        self.lookup_sessions = lookup_sessions and not history and not replay
+
+    def current_session(self, player, shard=None):
+        # After a restart the session is picked up from Redis, once per player
+        if player not in self.sessions:
+            session = get_redis().hget(player_stats_key(player, shard), "session") if self.lookup_sessions else None
+            self.sessions[player] = session.decode() if session else None
+        return self.sessions[player]
+
+    def replayed_session(self, player, shard, event):
+        # The session with the latest start at or before the event
+        starts = self.starts.get((player, shard), [])
+        i = bisect.bisect_right([start for start, _ in starts], event_epoch(event))
+        return starts[i - 1][1] if i else None
+
+    def write(self, pipe, events, shard=None):
+        # Counts are summed over the batch first, so a batch costs one
+        # HINCRBY per changed field rather than several commands per event
+        counts = {}
+        last_seen = {}
+        leaderboards = {}
+        for event in events:
+            player = event["player"]
+            kind = event["type"]
+            details = event["details"]
+            if kind == "connection" and details.get("session"):
+                session = details["session"]
+                self.sessions[player] = session
+                latest = True
+                if self.replay:
+                    # After any session starting in the same second, as stored
+                    starts = self.starts.setdefault((player, shard), [])
+                    start = event_epoch(event)
+                    i = bisect.bisect_right([s for s, _ in starts], start)
+                    starts.insert(i, (start, session))
+                    latest = i == len(starts) - 1
+                if not self.history and latest:
+                    pipe.hset(player_stats_key(player, shard), "session", session)
+                pipe.hset(session_stats_key(session, shard), mapping={"player": player, "started": event["timestamp"]})
+                pipe.zadd(player_sessions_key(player, shard), {session: event_epoch(event)})
+
+            fields = ["events", kind]
+            if kind in LEADERBOARDS:
+                key = (leaderboard_key(kind, shard), player)
+                leaderboards[key] = leaderboards.get(key, 0) + 1
+                if details.get("cause"):
+                    fields.append(f"{kind}s:{details['cause']}")
+
+            keys = [player_stats_key(player, shard)]
+            session = self.replayed_session(player, shard, event) if self.replay else self.current_session(player, shard)
+            if session:
+                keys.append(session_stats_key(session, shard))
+            for key in keys:
+                key_counts = counts.setdefault(key, {})
+                for field in fields:
+                    key_counts[field] = key_counts.get(field, 0) + 1
+                last_seen[key] = max(last_seen.get(key, ""), event["timestamp"]) if self.replay else event["timestamp"]
+
+        for key, key_counts in counts.items():
+            for field, count in key_counts.items():
+                pipe.hincrby(key, field, count)
+            if self.replay:
+                if last_seen[key] > self.seen.get(key, ""):
+                    self.seen[key] = last_seen[key]
+                    pipe.hset(key, "last_seen", last_seen[key])
+            elif self.history and key.startswith(player_stats_key("", shard)):
+                pipe.hsetnx(key, "last_seen", last_seen[key])
+            else:
+                pipe.hset(key, "last_seen", last_seen[key])
+        for (board, player), count in leaderboards.items():
+            pipe.zincrby(board, count, player)
+
+    def reset(self):
+        pass
+
+def create_aggregate_store(config, history=False):
+    if config.get('aggregates', False):
+        return AggregateStore(history=history)
+    return None
+
+def get_player_stats(player, shard=None):
+    # For consumers of the aggregates: counts as ints plus the K/D ratio
+    stats = {key.decode(): value.decode() for key, value in get_redis().hgetall(player_stats_key(player, shard)).items()}
+    stats = {key: int(value) if value.isdigit() else value for key, value in stats.items()}
+    stats["kd"] = round(stats.get("kill", 0) / max(stats.get("death", 0), 1), 2)
+    return stats
+
+def get_leaderboard(kind="kill", count=10, shard=None):
+    # Top players as (player, count) pairs, highest first. The sharded layout
+    # keeps a leaderboard per team
+    return [(player.decode(), int(score)) for player, score in get_redis().zrevrange(leaderboard_key(kind, shard), 0, count - 1, withscores=True)]
+
+def event_keys(config):
+    # The keys holding events with the configured storage and key layout
+    sharded = config.get('key_layout', 'global') == 'sharded'
+    if config.get('storage', 'json') == 'streams':
+        keys = [key.decode() for key in get_redis().scan_iter(match=shard_key("events", "*") if sharded else "events:*", _type="stream")]
+        return [key for key in keys if (key_shard(key) is not None) == sharded]
+    key = "events:v1" if config.get('event_format', 'legacy') == 'compact' else "events"
+    if sharded:
+        return [key.decode() for key in get_redis().scan_iter(match=shard_key(key, "*"), _type="ReJSON-RL")]
+    return [key]
+
+def stored_events(config):
+    # Yields (shard, events) batches of the stored events, oldest first,
+    # decoded to the legacy shape. The shard is None for the global layout
+    if config.get('storage', 'json') == 'streams':
+        for key in event_keys(config):
+            last_id = "0-0"
+            while True:
+                entries = read_stream_events(key, last_id, count=REBUILD_BATCH_SIZE)
+                if not entries:
+                    break
+                last_id = entries[-1][0]
+                yield key_shard(key), [event for _, event in entries]
+        return
+
+    compact = config.get('event_format', 'legacy') == 'compact'
+    for key in event_keys(config):
+        length = get_redis().json().arrlen(key) or 0
+        for start in range(0, length, REBUILD_BATCH_SIZE):
+            events = get_redis().json().get(key, f"$[{start}:{start + REBUILD_BATCH_SIZE}]")
+            yield key_shard(key), decode_events(events) if compact else events
+
+def rebuild_aggregates(config):
+    # Recomputes every aggregate from the stored events. Events published
+    # while this runs can be counted twice or not at all
+    sharded = config.get('key_layout', 'global') == 'sharded'
+    deleted = 0
+    for pattern in AGGREGATE_PATTERNS:
+        # Only the keys of the configured layout, e.g. while a migration is checked
+        keys = [key for key in get_redis().scan_iter(match=pattern, count=1000)
+                if (key_shard(key.decode()) is not None) == sharded]
+        for i in range(0, len(keys), 1000):
+            deleted += get_redis().delete(*keys[i:i + 1000])
+    print(f"Deleted {deleted} aggregate keys")
+
+    store = AggregateStore(replay=True)
+    total = 0
+    started = time.time()
+    for shard, events in stored_events(config):
+        pipe = shard_pipeline(shard)
+        store.write(pipe, events, shard)
+        pipe.execute()
+        total += len(events)
+    print(f"Counted {total} events in {time.time() - started:.1f}s")
+
+# Notifications are published on a Pub/Sub channel per team (or per player
+# without a team) in the same transaction as the writes, so listeners hear
+# about a kill or a new ship as soon as it is stored instead of polling.
+# They use the compact event shape with plain player names, e.g.
+#   {"v": 1, "t": 1725883130, "p": "Bob", "k": "k", "d": {"v": "Alice", "ca": "Bullet"}}
+# Ships entering the fleet are sent as type "ship"; ship losses already
+# arrive as ship_destroyed events
+NOTIFY_SHIP = "ship"
+NOTIFY_SHIP_CODE = "f"
+
+def notify_channel(name):
+    return f"notify:{name}"
+
+def encode_notification(kind, item):
+    if kind == "ship":
+        payload = {
+            "v": EVENT_FORMAT_VERSION,
+            "t": event_epoch(item),
+            "p": item["owner"],
+            "k": NOTIFY_SHIP_CODE,
+            "d": {"sh": item["id"], "n": item["name"]}
+        }
+    else:
+        payload = {
+            "v": EVENT_FORMAT_VERSION,
+            "t": event_epoch(item),
+            "p": item["player"],
+            "k": EVENT_TYPE_CODES.get(item["type"], item["type"]),
+            "d": {DETAIL_KEY_CODES.get(key, key): value for key, value in item["details"].items()}
+        }
+    if "channel" in item:
+        payload["c"] = item["channel"]
+    return json.dumps(payload, separators=(",", ":"))
+
+def decode_notification(data):
+    payload = json.loads(data)
+    if payload.get("k") != NOTIFY_SHIP_CODE:
+        return decode_event(payload, {})
+    notification = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(payload["t"])),
+        "player": payload["p"],
+        "type": NOTIFY_SHIP,
+        "details": {"ship": payload["d"]["sh"], "name": payload["d"]["n"]},
+        "metadata": None
+    }
+    if "c" in payload:
+        notification["channel"] = payload["c"]
+    return notification
+
+class NotificationStore:
+    def __init__(self, team=None, types=None):
+        self.team = team
+        self.types = set(types) if types else None  # Only these types are sent, all when empty
+
+    def write(self, pipe, ops, shard=None):
+        # Pub/Sub channels are not keys, so they are the same in both layouts
+        for kind, item in ops:
+            if kind == "ship_destroyed":
+                continue
+            notification_type = item["type"] if kind == "event" else NOTIFY_SHIP
+            if self.types and notification_type not in self.types:
+                continue
+            name = self.team or (item["player"] if kind == "event" else item["owner"])
+            pipe.publish(notify_channel(name), encode_notification(kind, item))
+
+    def reset(self):
+        pass
+
+def create_notification_store(config):
+    if config.get('notifications', False):
+        return NotificationStore(config.get('team'), config.get('notify_types'))
+    return None
+
+def subscribe_notifications(name, types=None):
+    # For listeners: yields notifications for a team or player as they are
+    # published, optionally only the given types. Blocks between messages
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(notify_channel(name))
+    try:
+        for message in pubsub.listen():
+            notification = decode_notification(message["data"])
+            if not types or notification["type"] in types:
+                yield notification
+    finally:
+        pubsub.close()
+
+def format_notification(notification):
+    details = " ".join(f"{key}={value}" for key, value in notification["details"].items())
+    channel = f" [{notification['channel']}]" if "channel" in notification else ""
+    return f"{notification['timestamp']}{channel} {notification['player']} {notification['type']} {details}"
+
+# With the sharded layout a ship lives in its owner's shard, but its loss is
+# seen in the logs of whoever was around. This index says where to remove it
+SHIP_SHARDS_KEY = "fleet:shards"
+
+class Publisher:
+    # Writes a batch of buffered ops to Redis in one pipelined round trip,
+    # or with the sharded layout in one transaction per shard in the batch
+    def __init__(self, event_store=None, fleet_store=None, aggregate_store=None, notification_store=None,
+                 sharded=False, team=None):
+        self.event_store = event_store or JsonEventStore()
+        self.fleet_store = fleet_store or JsonFleetStore()
+        self.aggregate_store = aggregate_store
+        self.notification_store = notification_store
+        self.sharded = sharded
+        self.team = team
+        self.last_shard = None
+
+    def shard_of(self, op):
+        kind, item = op
+        if self.team:
+            return self.team
+        if kind == "event":
+            return item["player"]
+        if kind == "ship":
+            return item["owner"]
+        # A ship loss is queued right after the player's ship_destroyed event
+        return self.last_shard
+
+    def split(self, ops):
+        # Ops grouped by shard, in the order each shard first appears
+        if not self.sharded:
+            return [(None, ops)]
+        owners = self.ship_shards(ops)
+        shards = {}
+        for i, op in enumerate(ops):
+            shard = owners.get(op[1]) if op[0] == "ship_destroyed" else None
+            if shard is None:
+                shard = self.shard_of(op)
+            if shard is None:
+                # A batch that starts with a ship loss, e.g. right after a
+                # restart. The next op usually comes from the same player
+                shard = next((self.shard_of(other) for other in ops[i + 1:] if other[0] != "ship_destroyed"), None)
+            if shard is None:
+                print(f"Skipping the loss of ship {op[1]}, its owner is not known")
+                continue
+            self.last_shard = shard
+            shards.setdefault(shard, []).append(op)
+        return list(shards.items())
+
+    def ship_shards(self, ops):
+        # Shards holding the ships lost in this batch, from the index or from
+        # the batch itself for ships added just before
+        lost = [item for kind, item in ops if kind == "ship_destroyed"]
+        if not lost:
+            return {}
+        owners = {ship_id: shard.decode() for ship_id, shard in zip(lost, get_redis().hmget(SHIP_SHARDS_KEY, lost)) if shard}
+        for op in ops:
+            if op[0] == "ship":
+                owners[op[1]["id"]] = self.shard_of(op)
+        return owners
+
+    def write(self, ops, pipe=None, shard=None, written=None):
+        # A pipeline can be passed in to send other commands in the same
+        # transaction, all ops then go to the given shard. With several shards
+        # in a batch each one sent is added to written, and a retry of the
+        # batch with the same set skips them
+        if pipe is not None:
+            self.send(ops, shard, pipe)
+            return
+        groups = self.split(ops)
+        if self.sharded:
+            # Indexed before the ships are written, so a loss right after
+            # always finds them. The index is a key of its own, outside
+            # every shard's slot
+            added = {item["id"]: shard for shard, shard_ops in groups for kind, item in shard_ops if kind == "ship"}
+            if added:
+                get_redis().hset(SHIP_SHARDS_KEY, mapping=added)
+        for shard, shard_ops in groups:
+            if written is not None and shard in written:
+                continue
+            self.send(shard_ops, shard)
+            if written is not None:
+                written.add(shard)
+        lost = [item for shard, shard_ops in groups for kind, item in shard_ops if kind == "ship_destroyed"]
+        if lost:
+            try:
+                get_redis().hdel(SHIP_SHARDS_KEY, *lost)
+            except Exception as e:
+                # The ships are gone already, a stale entry only costs memory
+                print(f"Error updating the ship index: {str(e)}")
+
+    def send(self, ops, shard, pipe=None):
+        attempt = 0
+        while True:
+            try:
+                tx = pipe if pipe is not None else shard_pipeline(shard)
+                events = [item for kind, item in ops if kind == "event"]
+                if events:
+                    self.event_store.write(tx, events, shard)
+                    if self.aggregate_store:
+                        self.aggregate_store.write(tx, events, shard)
+                fleet_ops = [op for op in ops if op[0] != "event"]
+                if fleet_ops:
+                    self.fleet_store.write(tx, fleet_ops, shard)
+                if self.notification_store:
+                    self.notification_store.write(tx, ops, shard)
+                started = time.perf_counter()
+                tx.execute()
+                metrics.observe("redis_write_seconds", time.perf_counter() - started)
+                metrics.inc("events_published", amount=len(events))
+                observe_publish_lag(events)
+                return
+            except Exception as e:
+                self.event_store.reset()
+                self.fleet_store.reset()
+                # The shard's slot moved to another node. Nothing in the
+                # transaction was applied, so it is built again for the new node
+                if pipe is None and attempt < CLUSTER_REDIRECTS and is_cluster_redirect(e):
+                    attempt += 1
+                    metrics.inc("cluster_redirects")
+                    refresh_cluster_slots()
+                    time.sleep(0.05 * attempt)
+                    continue
+                metrics.inc("redis_write_errors")
+                raise
+
+def create_publisher(config, notifications=True, history=False):
+    sharded = config.get('key_layout', 'global') == 'sharded'
+    return Publisher(create_event_store(config), create_fleet_store(config), create_aggregate_store(config, history),
+                     create_notification_store(config) if notifications else None, sharded, config.get('team'))
+
+# Every parsed op is written to a spool file on disk first and sent to Redis
+# from there by a background thread, so a slow or unreachable Redis never
+# holds up tailing and no event is lost while it is down
+SPOOL_FILE = os.path.join(APP_DATA_PATH, 'spool.ndjson')
+SPOOL_MAX_BYTES = 64 * 1024 * 1024  # Oldest unsent ops are dropped past this size
+SPOOL_COMPACT_BYTES = 1024 * 1024  # Sent ops are cut from the file once they take up this much
+SPOOL_BATCH_SIZE = 500  # Ops sent to Redis per pipeline
+SPOOL_RETRY_MIN = 1  # Seconds before the first retry after a failed send
+SPOOL_RETRY_MAX = 60  # Retries back off exponentially up to this many seconds
+
+class Spool:
+    def __init__(self, path=SPOOL_FILE, max_bytes=SPOOL_MAX_BYTES):
+        self.path = path
+        self.ack_path = path + '.ack'
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.has_data = threading.Event()
+        self.base = 0  # Bytes cut from the front of the file since it was opened
+        self.file = open(path, 'ab+')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.remove_partial_entry()
+        self.acked = self.load_ack()
+        if self.size > self.acked:
+            self.has_data.set()
+
+    def pending_bytes(self):
+        return self.size - self.acked
+
+    def remove_partial_entry(self):
+        # A crash in the middle of a write can leave half an entry at the end
+        if self.size:
+            self.file.seek(max(self.size - READ_CHUNK_SIZE, 0))
+            tail = self.file.read()
+            if not tail.endswith(b"\n"):
+                self.size -= len(tail) - tail.rfind(b"\n") - 1
+                self.file.truncate(self.size)
+
+    def load_ack(self):
+        try:
+            with open(self.ack_path, 'r') as f:
+                acked = int(f.read())
+        except:
+            return 0
+        # An offset past the end means the file was cut before the ack was saved
+        return acked if acked <= self.size else 0
+
+    def save_ack(self):
+        temp_file = self.ack_path + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(str(self.acked))
+        os.replace(temp_file, self.ack_path)
+
+    def write(self, ops):
+        data = b"".join(json.dumps(op, separators=(",", ":")).encode() + b"\n" for op in ops)
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(data)
+            if self.size - self.acked > self.max_bytes:
+                self.drop_oldest()
+            self.has_data.set()
+
+    def read(self, max_ops=SPOOL_BATCH_SIZE):
+        # Returns the oldest unsent ops and the position to acknowledge once
+        # they are sent. Positions count from when the spool was opened so they
+        # stay valid if the file is compacted in the meantime
+        with self.lock:
+            self.file.seek(self.acked)
+            ops = []
+            offset = self.acked
+            while len(ops) < max_ops and offset < self.size:
+                line = self.file.readline()
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    print("Skipping damaged spool entry")
+            return ops, self.base + offset
+
+    def ack(self, position):
+        with self.lock:
+            offset = position - self.base
+            if offset <= self.acked:
+                # Already dropped to make room
+                return
+            self.acked = offset
+            if self.acked >= self.size:
+                # Everything was sent, so the file can simply be emptied
+                self.file.truncate(0)
+                self.base += self.size
+                self.size = self.acked = 0
+                self.has_data.clear()
+            elif self.acked >= SPOOL_COMPACT_BYTES:
+                self.compact()
+            self.save_ack()
+
+    def drop_oldest(self):
+        # Keeps the newest half of the allowed size, starting on a whole entry
+        self.file.seek(self.size - self.max_bytes // 2)
+        self.file.readline()
+        dropped = self.file.tell() - self.acked
+        metrics.inc("spool_dropped_bytes", amount=dropped)
+        self.acked = self.file.tell()
+        print(f"Event spool full, dropped {dropped} bytes of the oldest unsent events")
+        self.compact()
+        self.save_ack()
+
+    def compact(self):
+        # Rewrites the file without the sent part. The ack is reset before the
+        # swap, so a crash in between resends ops rather than losing them
+        temp_file = self.path + '.tmp'
+        self.file.seek(self.acked)
+        with open(temp_file, 'wb') as f:
+            while True:
+                chunk = self.file.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        self.size -= self.acked
+        self.base += self.acked
+        self.acked = 0
+        self.save_ack()
+        self.file.close()
+        os.replace(temp_file, self.path)
+        self.file = open(self.path, 'ab+')
+
+class SpoolSender(threading.Thread):
+    # Drains the spool into Redis, backing off exponentially while Redis is unreachable
+    def __init__(self, spool, publisher):
+        super().__init__(daemon=True)
+        self.spool = spool
+        self.publisher = publisher
+        self.stopping = threading.Event()
+
+    def connect(self):
+        # Tailing is already running and spooling ops while this waits
+        delay = SPOOL_RETRY_MIN
+        while not self.stopping.is_set():
+            try:
+                get_redis().ping()
+                return
+            except Exception as e:
+                print(f"Error connecting to Redis, retrying in {delay}s: {str(e)}")
+                self.stopping.wait(delay)
+                delay = min(delay * 2, SPOOL_RETRY_MAX)
+
+    def run(self):
+        import redis
+        self.connect()
+        delay = SPOOL_RETRY_MIN
+        rejected = False  # Redis rejected part of the current batch once already
+        batch = None
+        while not self.stopping.is_set():
+            if batch is None:
+                if not self.spool.has_data.wait(1):
+                    continue
+                # Kept until acknowledged, so a retry sends the same ops and
+                # skips the shards already written
+                ops, position = self.spool.read()
+                batch = (ops, position, set())
+            ops, position, written = batch
+            if ops:
+                try:
+                    self.publisher.write(ops, written=written)
+                except Exception as e:
+                    if not isinstance(e, redis.ResponseError) or is_cluster_redirect(e) or is_aborted_write(e):
+                        print(f"Error saving events, retrying in {delay}s: {str(e)}")
+                        self.stopping.wait(delay)
+                        delay = min(delay * 2, SPOOL_RETRY_MAX)
+                        continue
+                    if not rejected:
+                        # E.g. a key deleted while the stores still had it
+                        # cached as created. The failed write reset them, so
+                        # one more try creates it again
+                        print(f"Error saving events, retrying: {str(e)}")
+                        rejected = True
+                        continue
+                    # Rejected again, sending it once more would only
+                    # duplicate the part Redis applied
+                    print(f"Error saving events: {str(e)}")
+            delay = SPOOL_RETRY_MIN
+            rejected = False
+            batch = None
+            self.spool.ack(position)
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        self.join(timeout)
+
+# Coalescing sits in front of the batch buffer and cuts writes that would not
+# change anything: repeats of a state that is already written, bursts of
+# changes where only the latest counts, and types over their rate limit
+COALESCE_WINDOW = 5  # Seconds after a state is written during which only its latest value is kept
+# Never held back, rate limited or dropped. The nearby types come from the
+# same death lines as kills and deaths, and a lost ship must leave the fleet
+PROTECTED_TYPES = ("kill", "death", "nearby_kill", "nearby_death", "ship_destroyed")
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # Tokens added per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        self.refill(now)
+        return (1 - self.tokens) / self.rate
+
+def op_type(op):
+    kind, item = op
+    return item["type"] if kind == "event" else kind
+
+class Coalescer:
+    def __init__(self, window=COALESCE_WINDOW, rate_limits=None, clock=time.time):
+        self.window = window  # None only holds states back for the rate limits
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in (rate_limits or {}).items()
+                        if kind not in PROTECTED_TYPES}
+        self.clock = clock
+        self.written = {}  # State key -> value last written
+        self.held = {}  # State key -> (op, value), the latest change waiting for its window to end
+        self.window_end = {}  # State key -> time the next change may be written
+
+    def state(self, op):
+        # Locations and ship entries describe where a player or ship is now,
+        # so only the latest value of each needs writing
+        kind, item = op
+        if self.window is None and op_type(op) not in self.buckets:
+            return None, None
+        if kind == "ship":
+            return ("ship", item["id"]), (item["name"], item["owner"], item["captain"], item.get("channel"))
+        if kind == "event" and item["type"] == "location":
+            return ("location", item["player"], item.get("channel")), item["details"]["location"]
+        return None, None
+
+    def admit(self, op):
+        # Returns the ops to write now, none if this one was saved
+        now = self.clock()
+        kind, item = op
+        if kind == "ship_destroyed":
+            return self.forget(("ship", item)) + [op]
+        if op_type(op) == "connection":
+            # A new session starts clean, its first location is always written
+            return self.forget(("location", item["player"], item.get("channel"))) + [op]
+        bucket = self.buckets.get(op_type(op))
+        key, value = self.state(op)
+        if key is None:
+            if bucket is None or bucket.take(now):
+                return [op]
+            metrics.inc("writes_saved", "rate_limited")
+            return []
+
+        if key in self.held:
+            metrics.inc("writes_saved", "coalesced")
+            self.held[key] = (op, value)
+            return []
+        if self.written.get(key) == value:
+            metrics.inc("writes_saved", "duplicate")
+            return []
+        if now < self.window_end.get(key, 0):
+            self.held[key] = (op, value)
+            return []
+        if bucket is not None and not bucket.take(now):
+            # Over the limit a state is held rather than dropped, so the
+            # latest value still gets written once a token is free
+            self.held[key] = (op, value)
+            self.window_end[key] = now + bucket.wait_time(now)
+            return []
+        self.written[key] = value
+        self.window_end[key] = now + (self.window or 0)
+        return [op]
+
+    def release(self, everything=False):
+        # Held states whose window has ended, or all of them when stopping
+        now = self.clock()
+        ops = []
+        for key, (op, value) in list(self.held.items()):
+            if not everything:
+                if now < self.window_end[key]:
+                    continue
+                bucket = self.buckets.get(op_type(op))
+                if bucket is not None and not bucket.take(now):
+                    self.window_end[key] = now + bucket.wait_time(now)
+                    continue
+            del self.held[key]
+            if self.written.get(key) == value:
+                # Changed and changed back within the window
+                metrics.inc("writes_saved", "duplicate")
+                continue
+            self.written[key] = value
+            self.window_end[key] = now + (self.window or 0)
+            ops.append(op)
+        return ops
+
+    def forget(self, key):
+        # Writes a held state straight away and clears what was written, e.g.
+        # when the ship is destroyed or a new session starts
+        self.written.pop(key, None)
+        self.window_end.pop(key, None)
+        held = self.held.pop(key, None)
+        return [held[0]] if held else []
+
+def create_coalescer(config):
+    rate_limits = dict(config.get('rate_limits', {}))
+    for kind in PROTECTED_TYPES:
+        if rate_limits.pop(kind, None) is not None:
+            print(f"Ignoring the rate limit for {kind}, kills, deaths and ship losses are never dropped")
+    if rate_limits.pop("connection", None) is not None:
+        print("Ignoring the rate limit for connection, every new session is written")
+    for kind, limit in list(rate_limits.items()):
+        try:
+            rate, burst = limit
+            valid = rate > 0 and burst >= 1
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            print(f"Ignoring the rate limit for {kind}, it needs [per second, burst] with a rate above 0 and a burst of at least 1")
+            del rate_limits[kind]
+    if not config.get('coalesce', False) and not rate_limits:
+        return None
+    window = config.get('coalesce_window', COALESCE_WINDOW) if config.get('coalesce', False) else None
+    return Coalescer(window, rate_limits)
+
+# Writes are buffered and handed over in batches, either to the spool or
+# straight to a Publisher
+EVENT_BATCH_SIZE = 200  # Flush once this many writes are queued
+EVENT_BATCH_AGE = 2  # Flush once the oldest queued write is this many seconds old
+
+class EventBuffer:
+    def __init__(self, sink=None, max_size=EVENT_BATCH_SIZE, max_age=EVENT_BATCH_AGE, coalescer=None):
+        self.sink = sink or Publisher()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.coalescer = coalescer
+        self.pending = []
+        self.oldest = 0
+
+    def add_event(self, event):
+        self.queue(("event", event))
+
+    def add_ship(self, ship):
+        self.queue(("ship", ship))
+
+    def remove_ship(self, ship_id):
+        self.queue(("ship_destroyed", ship_id))
+
+    def queue(self, op):
+        ops = [op] if self.coalescer is None else self.coalescer.admit(op)
+        if not ops:
+            return
+        if not self.pending:
+            self.oldest = time.time()
+        self.pending.extend(ops)
+        if len(self.pending) >= self.max_size or time.time() - self.oldest >= self.max_age:
+            self.flush()
+
+    def flush(self, final=False):
+        if self.coalescer is not None:
+            self.pending.extend(self.coalescer.release(final))
+        if not self.pending:
+            return
+        ops, self.pending = self.pending, []
+        try:
+            self.sink.write(ops)
+        except Exception as e:
+            print(f"Error saving events: {str(e)}")
+
+# Every event rule needs one of these markers in the line, checked in this order
+LINE_RULES = (
+    ("<SystemQuit>", "parse_quit"),
+    ("<Expect Incoming Connection>", "parse_connection"),
+    ("Location[", "parse_location"),
+    ("<Actor Death>", "parse_actor_death"),
+    ("OnEntityEnterZone", "parse_ship_entry"),
+    ("<Vehicle Destruction>", "parse_ship_destruction"),
+)
+
+def field_pattern(start, stop):
+    # Matches the same text as line.split(start)[1].split(stop)[0]
+    start = re.escape(start)
+    return re.compile(f"{start}((?:(?!{start})[^{re.escape(stop)}])*)")
+
+NICKNAME_PATTERN = field_pattern('nickname="', '"')
+SESSION_PATTERN = field_pattern("session=", " ")
+PLAYER_GEID_PATTERN = field_pattern("playerGEID=", " ")
+VICTIM_PATTERN = field_pattern("'", "'")
+KILLER_PATTERN = field_pattern("killed by '", "'")
+DAMAGE_TYPE_PATTERN = field_pattern("damage type '", "'")
+SHIP_ENTITY_PATTERN = field_pattern("Entity [", "]")
+VEHICLE_PATTERN = field_pattern("Vehicle '", "'")
+SHIP_MANUFACTURERS = ("AEGS", "ARGO", "ANVL", "CRUS", "DRAK", "MISC", "RSI", "ORIG", "MIRA")
+
+LINE_MARKERS = [marker.encode() for marker, _ in LINE_RULES]
+
+def find_marked_lines(data):
+    # Most of the log is noise, so instead of decoding and testing every line we
+    # search the raw bytes for each marker and only decode the lines containing one
+    starts = set()
+    for marker in LINE_MARKERS:
+        i = data.find(marker)
+        while i != -1:
+            starts.add(data.rfind(b"\n", 0, i) + 1)
+            end = data.find(b"\n", i)
+            if end == -1:
+                break
+            i = data.find(marker, end)
 
-try:
-    r = redis.Redis.from_url(REDIS_URL)
-    # Test the connection
-    r.ping()
-except Exception as e:
-    print(f"Error connecting")
-    sys.exit(1)
+    for start in sorted(starts):
+        end = data.find(b"\n", start)
+        yield decode_line(data[start:] if end == -1 else data[start:end + 1])
+
+_last_timestamp = (None, None)
+
+def utc_timestamp():
+    # Formatting is only redone when the second changes, bursts of events share it
+    global _last_timestamp
+    now = int(time.time())
+    if _last_timestamp[0] != now:
+        _last_timestamp = (now, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now)))
+    return _last_timestamp[1]
+
+LINE_TIMESTAMP_PATTERN = re.compile(r"<(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?Z>")
+
+def line_timestamp(line):
+    # Time the game wrote on the line, in the same format as utc_timestamp
+    match = LINE_TIMESTAMP_PATTERN.match(line)
+    return match.group(1) + "Z" if match else None
+
+def line_time(line):
+    # Seconds since the epoch at which the game wrote the line
+    match = LINE_TIMESTAMP_PATTERN.match(line)
+    if not match:
+        return None
+    return calendar.timegm(time.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S")) + float(match.group(2) or 0)
+
+def decode_line(raw):
+    # Gives the same text as reading the file in text mode
+    line = raw.decode('utf-8', errors='ignore')
+    if line.endswith('\r\n'):
+        line = line[:-2] + '\n'
+    return line
+
+READ_CHUNK_SIZE = 1024 * 1024  # Game.log is read in chunks of this many bytes
+
+def open_log_file(path):
+    if os.name != 'nt':
+        return open(path, 'rb')
+    # The game moves Game.log into logbackups when it starts, so the handle we
+    # keep open has to allow the file to be renamed or deleted underneath us
+    import msvcrt
+    import win32file
+    handle = win32file.CreateFile(
+        path,
+        win32file.GENERIC_READ,
+        win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE | win32file.FILE_SHARE_DELETE,
+        None,
+        win32file.OPEN_EXISTING,
+        0,
+        None
+    )
+    return os.fdopen(msvcrt.open_osfhandle(handle.Detach(), os.O_RDONLY), 'rb')
+
+FINGERPRINT_BYTES = 4096  # Start of Game.log hashed to tell game sessions apart
+LOGIN_MARKER = b"<AccountLoginCharacterStatus_Character>"
+
+def file_fingerprint(file, head_size=FINGERPRINT_BYTES):
+    # File identity plus a hash of its first bytes, which include the session start time
+    stat = os.fstat(file.fileno())
+    file.seek(0)
+    head = file.read(head_size)
+    return {
+        "device": stat.st_dev,
+        "inode": stat.st_ino,
+        "head_size": len(head),
+        "head": hashlib.sha1(head).hexdigest()
+    }
+
+def find_rotated_log(folder, fingerprint):
+    # The game moves Game.log into logbackups under a new name when it starts.
+    # Newest backups are checked first, only their first bytes are read
+    try:
+        paths = [os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(".log")]
+        paths.sort(key=os.path.getmtime, reverse=True)
+    except OSError:
+        return None
+    for path in paths:
+        try:
+            with open(path, 'rb') as file:
+                if file_fingerprint(file, fingerprint["head_size"])["head"] == fingerprint["head"]:
+                    return path
+        except OSError:
+            pass
+    return None
+
+def find_player_name(path):
+    # Searches the raw bytes a chunk at a time instead of decoding the log line by line
+    with open(path, 'rb') as file:
+        data = b""
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            data += chunk
+            # Only complete lines are searched until the end of the file is reached
+            end = data.rfind(b"\n") + 1 if chunk else len(data)
+            i = data.find(LOGIN_MARKER, 0, end)
+            while i != -1:
+                start = data.rfind(b"\n", 0, i) + 1
+                stop = data.find(b"\n", i, end)
+                line = decode_line(data[start:end] if stop == -1 else data[start:stop + 1])
+                if "name " in line:
+                    return line.split("name ")[1].split(" -")[0]
+                i = -1 if stop == -1 else data.find(LOGIN_MARKER, stop, end)
+            if not chunk:
+                return None
+            data = data[end:]
+
+# Reads are triggered by change notifications from the observer; polling is only a safety net
+POLL_INTERVAL = 10  # Read at least this often even if no notification arrives
+READ_DEBOUNCE = 0.1  # Wait this long after a change so a burst of writes is read in one pass
+MAX_READS_PER_SECOND = 4  # Cap on reads during heavy log spam
 
 class FileWatcher(FileSystemEventHandler):
-    def __init__(self, file_path):
+    def __init__(self, file_path, buffer=None, max_reads_per_second=MAX_READS_PER_SECOND, player_name=None,
+                 channel=None, checkpoints=None, wake=None):
         self.file_path = file_path
-        self.player_name = self.get_player_name()
-        self.last_position = self.get_file_size()
+        self.channel = channel  # LIVE, PTU or EPTU when several logs are watched, added to events and ships
+        self.wake = wake  # Set on changes as well, for a loop serving several watchers
+        self.watch_path = os.path.normcase(os.path.abspath(file_path))
+        self.file = None  # Kept open between reads
+        self.partial = b""  # Unfinished last line from the previous read
+        self.fingerprint = None
+        self.line_timestamps = False  # Use the time written on each log line instead of now
+        if player_name is not None:
+            # Archived logs are read from the start for a known player
+            self.checkpoints = {}
+            self.player_name = player_name
+            self.last_position = 0
+            self.tail_start = 0
+        else:
+            self.checkpoints = load_checkpoints() if checkpoints is None else checkpoints
+            if not self.resume_from_checkpoint():
+                self.player_name = self.get_player_name()
+                self.last_position = self.get_file_size()
+                self.tail_start = self.last_position  # Offset this log was first read from
+        self.saved_checkpoint = None  # (offset, fingerprint) last saved
+        self.recorded_tail = None
         self.last_change_time = 0  # Initialize last change time    
+        self.last_read_time = 0
+        self.min_read_interval = 1 / max_reads_per_second
+        self.changed = threading.Event()
+        self.game_quit = False
         self.events = []  # Keep this as we still use it for tracking
+        self.buffer = buffer or EventBuffer()
+
+    @property
+    def player_name(self):
+        return self._player_name
+
+    @player_name.setter
+    def player_name(self, name):
+        self._player_name = name
+        # Per-player markers are only rebuilt when the name changes
+        self.location_marker = f"Player[{name}]"
+        self.owner_marker = f"m_ownerGEID[{name}]"
+
+    def resume_from_checkpoint(self):
+        # Picks up where the last run stopped if Game.log is still the same file,
+        # so events written while Picologs was closed are not lost
+        checkpoint = self.checkpoints.get(self.file_path)
+        if not checkpoint:
+            return False
+        try:
+            self.file = open_log_file(self.file_path)
+            fingerprint = file_fingerprint(self.file, checkpoint["fingerprint"]["head_size"])
+            if fingerprint != checkpoint["fingerprint"] or checkpoint["offset"] > os.fstat(self.file.fileno()).st_size:
+                self.close()
+                return self.resume_from_backup(checkpoint)
+        except Exception:
+            self.close()
+            return False
+
+        self.player_name = checkpoint["player_name"]
+        self.last_position = checkpoint["offset"]
+        self.tail_start = checkpoint.get("start", 0)
+        print(f"Resuming Game.log from byte {self.last_position}")
+        return True
+
+    def resume_from_backup(self, checkpoint):
+        # The game started a new Game.log while Picologs was closed. The old one
+        # is opened in logbackups and read from the checkpoint, the first read
+        # then sees it is no longer Game.log and moves on to the new file
+        path = find_rotated_log(os.path.join(os.path.dirname(self.file_path), BACKFILL_DIR), checkpoint["fingerprint"])
+        if path is None:
+            return False
+        try:
+            self.file = open_log_file(path)
+        except Exception:
+            return False
+        self.fingerprint = checkpoint["fingerprint"]
+        self.player_name = checkpoint["player_name"]
+        self.last_position = checkpoint["offset"]
+        self.tail_start = checkpoint.get("start", 0)
+        print(f"Game.log was replaced, finishing the previous log from byte {self.last_position} of {path}")
+        return True
+
+    def update_fingerprint(self):
+        # The hash is extended until the file is long enough for a full fingerprint
+        if self.file is not None and (self.fingerprint is None or self.fingerprint["head_size"] < FINGERPRINT_BYTES):
+            self.fingerprint = file_fingerprint(self.file)
+
+    def save_checkpoint(self):
+        self.update_fingerprint()
+        self.write_checkpoint(self.last_position, self.fingerprint, self.tail_start, self.player_name)
+
+    def write_checkpoint(self, offset, fingerprint, start, player_name):
+        # A new log can reach the same offset as the old one, so the
+        # fingerprint is compared too
+        if fingerprint is None or self.saved_checkpoint == (offset, fingerprint):
+            return
+        with checkpoint_lock:
+            self.checkpoints[self.file_path] = {
+                "fingerprint": fingerprint,
+                "offset": offset,
+                "start": start,
+                "player_name": player_name
+            }
+        try:
+            save_checkpoints(self.checkpoints)
+            self.saved_checkpoint = (offset, fingerprint)
+            if self.recorded_tail != (fingerprint["head"], start):
+                record_tailed_log(fingerprint, start)
+                self.recorded_tail = (fingerprint["head"], start)
+        except Exception as e:
+            print(f"Error saving checkpoint: {str(e)}")
+
+    def on_modified(self, event):
+        if not event.is_directory and os.path.normcase(os.path.abspath(event.src_path)) == self.watch_path:
+            self.changed.set()
+            if self.wake is not None:
+                self.wake.set()
+
+    # Game.log is recreated when the game starts
+    on_created = on_modified
+
+    def wait_for_change(self, timeout):
+        deadline = time.time() + timeout
+        # Wait in short steps so Ctrl+C is still handled promptly on Windows
+        while not self.changed.wait(min(1, max(deadline - time.time(), 0))):
+            if time.time() >= deadline:
+                break
+        else:
+            time.sleep(READ_DEBOUNCE)
+
+        delay = self.last_read_time + self.min_read_interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        # Cleared before reading so writes made during the read trigger another pass
+        self.changed.clear()
         
     def get_file_size(self):
         try:
@@ -319,9 +1943,16 @@ class FileWatcher(FileSystemEventHandler):
         return []
                
         
+    def event_timestamp(self, line):
+        if self.line_timestamps:
+            timestamp = line_timestamp(line)
+            if timestamp is not None:
+                return timestamp
+        return utc_timestamp()
+
     def save_event(self, event_type, details, metadata=None, timestamp=None):
         if timestamp is None:
-            timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            timestamp = self.event_timestamp(metadata["line"] if metadata else "")
             
         event = {
             "timestamp": timestamp,
@@ -330,145 +1961,869 @@ class FileWatcher(FileSystemEventHandler):
             "details": details,
             "metadata": metadata
         }
+        if self.channel is not None:
+            event["channel"] = self.channel
         
-        try:        
-            # Push to REDIS JSON list
-            if not r.exists("events"):
-                r.json().set("events", "$", [])
-            r.json().arrappend("events", "$", event)
-                
-        except Exception as e:
-            print(f"Error saving event: {str(e)}")
+        # Queued and pushed to Redis with the rest of the read pass
+        metrics.inc("events", event_type)
+        self.buffer.add_event(event)
             
     def check_file(self):
+        self.last_read_time = time.time()
         try:
-            current_size = os.path.getsize(self.file_path)
-            if current_size < self.last_position:
-                # print(f"File was truncated, resetting position from {self.last_position} to 0")
-                self.last_position = 0
-                
-            # Update last change time when we detect new content
-            self.last_change_time = time.time()
-                
-            # print(f"Reading file from position {self.last_position} to {current_size}")
-            with open(self.file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                file.seek(self.last_position)
-                new_lines = file.readlines()
-                self.last_position = file.tell()
-                
-                # print(f"Found {len(new_lines)} new lines to process")
-                for line in new_lines:
-                    
-                    # Check for system quit
-                    if "<SystemQuit>" in line:
-                        self.save_event("quit", {
-                            "status": "offline",
-                            "player": self.player_name
-                        }, metadata={"line": line})
-                        
-                    # Check for player connection
-                    if "<Expect Incoming Connection>" in line:
-                        try:
-                            nickname = line.split('nickname="')[1].split('"')[0]
-                            session = line.split('session=')[1].split(' ')[0]
-                            player_geid = line.split('playerGEID=')[1].split(' ')[0]
-                            # Use nickname as the player name
-                            self.player_name = nickname
-                            self.save_event("connection", {
-                                "session": session,
-                                "player_geid": player_geid
-                            }, metadata={"line": line})
-                        except:
-                            print("Failed to parse connection event")
-                    
-                    # Check for location updates
-                    if f"Player[{self.player_name}]" in line and "Location[" in line:
-                        location = line[line.find("Location["):].split("]")[0] + "]"
-                        self.save_event("location", {"location": location}, metadata={"line": line})
-                    
-                    # Check for deaths
-                    if "<Actor Death>" in line and self.player_name in line:
-                        try:
-                            victim = line.split("'")[1]
-                            killer = line.split("killed by '")[1].split("'")[0]
-                            damage_type = line.split("damage type '")[1].split("'")[0]
-                            
-                            if self.player_name == victim:
-                                if victim == killer:
-                                    self.save_event("death", {"type": "self", "cause": damage_type}, metadata={"line": line})
-                                else:
-                                    self.save_event("death", {"type": "killed", "killer": killer, "cause": damage_type}, metadata={"line": line})
-                            elif self.player_name == killer:
-                                self.save_event("kill", {"victim": victim, "cause": damage_type}, metadata={"line": line})
-                        except:
-                            self.save_event("death", {"type": "unknown"}, metadata={"line": line})
-
-                     # Check for all deaths
-                    if "<Actor Death>" in line:
-                        try:
-                            victim = line.split("'")[1]
-                            killer = line.split("killed by '")[1].split("'")[0]
-                            damage_type = line.split("damage type '")[1].split("'")[0]
-                            
-                            if self.player_name == victim:
-                                if victim == killer:
-                                    self.save_event("nearby_death", {"type": "self", "cause": damage_type}, metadata={"line": line})
-                                else:
-                                    self.save_event("nearby_death", {"type": "killed", "killer": killer, "cause": damage_type}, metadata={"line": line})
-                            elif self.player_name == killer:
-                                self.save_event("nearby_kill", {"victim": victim, "cause": damage_type}, metadata={"line": line})
-                        except:
-                            self.save_event("nearby_death", {"type": "unknown"}, metadata={"line": line})
-
-                    # Check for ship entry
-                    if "Entity [" in line and f"m_ownerGEID[{self.player_name}]" in line and "OnEntityEnterZone" in line:
-                        try:
-                            ship_type = line.split("Entity [")[1].split("]")[0]
-                            ship_id = ship_type.split("_")[-1]
-                            if ship_type.startswith(("AEGS", "ARGO", "ANVL", "CRUS", "DRAK", "MISC", "RSI", "ORIG", "MIRA")) and "_" in ship_type:
-                                timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-                                ship_data = {
-                                    "id": ship_id,
-                                    "name": ship_type,
-                                    "owner": self.player_name,
-                                    "captain": self.player_name,
-                                    "timestamp": timestamp
-                                }
-                                if not r.exists("fleet"):
-                                    r.json().set("fleet", "$", [])
-                                r.json().arrappend("fleet", "$", ship_data)
-                        except:
-                            print("Failed to parse ship entry event")
-                            
+            for block in self.read_blocks():
+                self.process_block(block)
 
-                    #<Vehicle Destruction> CVehicle::OnAdvanceDestroyLevel: Vehicle 'ORIG_m50_1725883130384'
-                    if "<Vehicle Destruction>" in line and "Vehicle '" in line:
-                        try:
-                            ship_type = line.split("Vehicle '")[1].split("'")[0]
-                            ship_id = ship_type.split("_")[-1]
-                            self.save_event("ship_destroyed", {"ship": ship_id}, metadata={"line": line})
-                            r.json().delete('fleet', f"$[?(@.id == \"{ship_id}\")]")
-                        except:
-                            print("Failed to parse ship destruction event")
-                            
         except Exception as e:
             print(f"Error reading file: {str(e)}")
+            self.close()
+
+        self.buffer.flush()
+        self.save_checkpoint()
+
+    def file_change(self):
+        # "rotated" when the open file is no longer Game.log, which is how the
+        # game starts a new session. "rewritten" when it is the same file but
+        # starts differently, so it was truncated and written again. "missing"
+        # between the game moving Game.log away and creating the new one
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return "missing"
+        opened = os.fstat(self.file.fileno())
+        if (stat.st_dev, stat.st_ino) != (opened.st_dev, opened.st_ino):
+            return "rotated"
+        if self.fingerprint is not None and file_fingerprint(self.file, self.fingerprint["head_size"]) != self.fingerprint:
+            return "rewritten"
+        return None
+
+    def read_blocks(self):
+        # Yields the new data in chunks that end on a line break. An unfinished
+        # last line is held back until the game has written the rest of it
+        change = self.file_change() if self.file is not None else None
+        if change == "missing":
+            # The old log is finished through our handle, which is kept along
+            # with its unfinished last line until the new Game.log shows up
+            yield from self.read_available()
+            return
+        if change == "rotated":
+            # Our handle still points at the old log wherever it was moved, so
+            # what the game wrote to it since the last read is not lost
+            yield from self.read_available()
+            if self.partial:
+                yield self.partial
+        if change is not None:
+            print(f"Game.log was {change}, reading the new log from the start")
+            metrics.inc("log_rotations")
+            self.start_over()
+
+        if not os.path.exists(self.file_path):
+            return
+        current_size = os.path.getsize(self.file_path)
+        if current_size < self.last_position + len(self.partial):
+            # print(f"File was truncated, resetting position from {self.last_position} to 0")
+            self.start_over()
+            
+        # Update last change time when we detect new content
+        self.last_change_time = time.time()
+
+        # print(f"Reading file from position {self.last_position} to {current_size}")
+        if self.file is None:
+            self.file = open_log_file(self.file_path)
+            # After a failed read the offset only holds for the file read before
+            if self.last_position and self.fingerprint is not None and file_fingerprint(self.file, self.fingerprint["head_size"]) != self.fingerprint:
+                print("Game.log is not the file read before, reading it from the start")
+                self.fingerprint = None
+                self.last_position = 0
+                self.tail_start = 0
+        yield from self.read_available()
+
+    def read_available(self):
+        self.file.seek(self.last_position + len(self.partial))
+        while True:
+            chunk = self.file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = self.partial + chunk
+            end = data.rfind(b"\n") + 1
+            self.partial = data[end:]
+            if end:
+                self.last_position += end
+                metrics.inc("bytes_read", amount=end)
+                metrics.inc("lines_read", amount=data.count(b"\n", 0, end))
+                yield data[:end]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.partial = b""
+
+    def start_over(self):
+        # Reads whatever file is now at the path from its first byte
+        self.close()
+        self.fingerprint = None
+        self.last_position = 0
+        self.tail_start = 0
+
+    def process_block(self, data):
+        for line in find_marked_lines(data):
+            for marker, rule in LINE_RULES:
+                if marker in line:
+                    getattr(self, rule)(line)
+
+    def parse_quit(self, line):
+        self.game_quit = True
+        self.save_event("quit", {
+            "status": "offline",
+            "player": self.player_name
+        }, metadata={"line": line})
+
+    def parse_connection(self, line):
+        try:
+            nickname = NICKNAME_PATTERN.search(line).group(1)
+            session = SESSION_PATTERN.search(line).group(1)
+            player_geid = PLAYER_GEID_PATTERN.search(line).group(1)
+            # Use nickname as the player name
+            self.player_name = nickname
+            self.save_event("connection", {
+                "session": session,
+                "player_geid": player_geid
+            }, metadata={"line": line})
+        except Exception:
+            metrics.inc("parse_failures", "parse_connection")
+            print("Failed to parse connection event")
+
+    def parse_location(self, line):
+        if self.location_marker in line:
+            location = line[line.find("Location["):].split("]")[0] + "]"
+            self.save_event("location", {"location": location}, metadata={"line": line})
+
+    def parse_actor_death(self, line):
+        # Parsed once and reported both as our own death/kill and as a nearby one
+        try:
+            victim = VICTIM_PATTERN.search(line).group(1)
+            killer = KILLER_PATTERN.search(line).group(1)
+            damage_type = DAMAGE_TYPE_PATTERN.search(line).group(1)
+            death = (victim, killer, damage_type)
+        except AttributeError:
+            metrics.inc("parse_failures", "parse_actor_death")
+            death = None
+
+        if self.player_name in line:
+            self.save_death(line, death, "death", "kill")
+        self.save_death(line, death, "nearby_death", "nearby_kill")
+
+    def save_death(self, line, death, death_type, kill_type):
+        if death is None:
+            self.save_event(death_type, {"type": "unknown"}, metadata={"line": line})
+            return
+
+        victim, killer, damage_type = death
+        if self.player_name == victim:
+            if victim == killer:
+                self.save_event(death_type, {"type": "self", "cause": damage_type}, metadata={"line": line})
+            else:
+                self.save_event(death_type, {"type": "killed", "killer": killer, "cause": damage_type}, metadata={"line": line})
+        elif self.player_name == killer:
+            self.save_event(kill_type, {"victim": victim, "cause": damage_type}, metadata={"line": line})
+
+    def parse_ship_entry(self, line):
+        if "Entity [" not in line or self.owner_marker not in line:
+            return
+        try:
+            ship_type = SHIP_ENTITY_PATTERN.search(line).group(1)
+            ship_id = ship_type.split("_")[-1]
+            if ship_type.startswith(SHIP_MANUFACTURERS) and "_" in ship_type:
+                timestamp = self.event_timestamp(line)
+                ship_data = {
+                    "id": ship_id,
+                    "name": ship_type,
+                    "owner": self.player_name,
+                    "captain": self.player_name,
+                    "timestamp": timestamp
+                }
+                if self.channel is not None:
+                    ship_data["channel"] = self.channel
+                self.buffer.add_ship(ship_data)
+        except Exception:
+            metrics.inc("parse_failures", "parse_ship_entry")
+            print("Failed to parse ship entry event")
+
+    #<Vehicle Destruction> CVehicle::OnAdvanceDestroyLevel: Vehicle 'ORIG_m50_1725883130384'
+    def parse_ship_destruction(self, line):
+        match = VEHICLE_PATTERN.search(line)
+        if match:
+            ship_id = match.group(1).split("_")[-1]
+            self.save_event("ship_destroyed", {"ship": ship_id}, metadata={"line": line})
+            self.buffer.remove_ship(ship_id)
+        else:
+            metrics.inc("parse_failures", "parse_ship_destruction")
 
     def get_player_name(self):
         try:
-            with open(self.file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                for line in file:
-                    if "<AccountLoginCharacterStatus_Character>" in line and "name " in line:
-                        # Extract name from the line
-                        name = line.split("name ")[1].split(" -")[0]
-                        return name
+            name = find_player_name(self.file_path)
+            if name is not None:
+                return name
             print("Error: Could not find player name in log file!")
             sys.exit(1)  # Exit program if no name found
         except Exception as e:
             print(f"Error getting player name: {str(e)}")
             sys.exit(1)  # Exit program on error
 
+# Pipeline mode runs tailing, parsing and spooling on their own threads, joined
+# by bounded queues so a slow stage holds the others back instead of piling up
+QUEUE_BLOCKS = 16  # Chunks of Game.log waiting to be parsed
+QUEUE_BATCHES = 64  # Batches of parsed ops waiting to be spooled
+
+class Pipeline:
+    def __init__(self, watcher, spool, poll_interval=POLL_INTERVAL, exit_on_game_quit=False, stats_interval=STATS_INTERVAL):
+        self.watcher = watcher
+        self.spool = spool
+        self.poll_interval = poll_interval
+        self.exit_on_game_quit = exit_on_game_quit
+        self.stats_interval = stats_interval
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+        self.batches = queue.Queue(QUEUE_BATCHES)
+        metrics.gauge("queue_blocks", self.blocks.qsize)
+        metrics.gauge("queue_batches", self.batches.qsize)
+        self.stopping = threading.Event()
+        # The parser's buffer hands its batches to the spooling stage
+        watcher.buffer = EventBuffer(self, coalescer=watcher.buffer.coalescer)
+        self.threads = [
+            threading.Thread(target=self.tail, name="tailer", daemon=True),
+            threading.Thread(target=self.parse, name="parser", daemon=True),
+            threading.Thread(target=self.store, name="spooler", daemon=True)
+        ]
+
+    def run(self):
+        for thread in self.threads:
+            thread.start()
+        try:
+            next_report = time.time() + self.stats_interval
+            while self.threads[-1].is_alive():
+                self.threads[-1].join(1)
+                if self.stats_interval and time.time() >= next_report:
+                    print(metrics.summary())
+                    print(self.stats())
+                    next_report += self.stats_interval
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in self.threads:
+                thread.join()
+            raise
+
+    def stop(self):
+        self.stopping.set()
+        self.watcher.changed.set()
+
+    def stats(self):
+        return (f"Queues: blocks {self.blocks.qsize()}/{QUEUE_BLOCKS}, "
+                f"batches {self.batches.qsize()}/{QUEUE_BATCHES}, "
+                f"spool {self.spool.pending_bytes()} bytes unsent")
+
+    def write(self, ops):
+        self.batches.put(("ops", ops))
+
+    def tail(self):
+        watcher = self.watcher
+        while not self.stopping.is_set():
+            watcher.last_read_time = time.time()
+            try:
+                for block in watcher.read_blocks():
+                    self.blocks.put(("block", block))
+                    if self.stopping.is_set():
+                        break
+                watcher.update_fingerprint()
+            except Exception as e:
+                print(f"Error reading file: {str(e)}")
+                watcher.close()
+            self.blocks.put(("checkpoint", watcher.last_position, watcher.fingerprint, watcher.tail_start))
+            if not self.stopping.is_set():
+                watcher.wait_for_change(self.poll_interval)
+        self.blocks.put(None)
+
+    def parse(self):
+        watcher = self.watcher
+        while True:
+            item = self.blocks.get()
+            if item is None:
+                break
+            if item[0] == "block":
+                watcher.process_block(item[1])
+                if watcher.game_quit:
+                    # Send the quit out straight away rather than waiting for the batch
+                    watcher.game_quit = False
+                    watcher.buffer.flush()
+                    if self.exit_on_game_quit:
+                        self.stop()
+            else:
+                watcher.buffer.flush()
+                self.batches.put(item + (watcher.player_name,))
+        watcher.buffer.flush(final=True)
+        self.batches.put(None)
+
+    def store(self):
+        while True:
+            item = self.batches.get()
+            if item is None:
+                break
+            if item[0] == "ops":
+                try:
+                    self.spool.write(item[1])
+                except Exception as e:
+                    print(f"Error saving events: {str(e)}")
+            else:
+                # Only reached once every op from before the checkpoint is spooled
+                self.watcher.write_checkpoint(*item[1:])
+
+# Several Game.logs (e.g. LIVE, PTU and EPTU) are served by one thread with one
+# observer, one spool and one Redis connection pool. A change to any of them
+# wakes the loop, and only logs that changed or are due a safety-net read are read
+class LogGroup:
+    def __init__(self, paths, buffer, max_reads_per_second=MAX_READS_PER_SECOND, poll_interval=POLL_INTERVAL):
+        self.wake = threading.Event()
+        self.poll_interval = poll_interval
+        checkpoints = load_checkpoints()
+        self.watchers = [
+            FileWatcher(path, buffer=buffer, max_reads_per_second=max_reads_per_second,
+                        channel=channel, checkpoints=checkpoints, wake=self.wake)
+            for channel, path in paths.items()
+        ]
+
+    def check_files(self):
+        now = time.time()
+        for watcher in self.watchers:
+            due = watcher.changed.is_set() or now >= watcher.last_read_time + self.poll_interval
+            if due and now >= watcher.last_read_time + watcher.min_read_interval:
+                # Cleared before reading so writes made during the read trigger another pass
+                watcher.changed.clear()
+                watcher.check_file()
+
+    def wait_for_change(self):
+        # Sleeps until a log changes or the next one is due a read. Logs held
+        # back by the read cap are due as soon as the cap allows
+        deadline = min(
+            watcher.last_read_time + (watcher.min_read_interval if watcher.changed.is_set() else self.poll_interval)
+            for watcher in self.watchers
+        )
+        # Wait in short steps so Ctrl+C is still handled promptly on Windows
+        while not self.wake.wait(min(1, max(deadline - time.time(), 0))):
+            if time.time() >= deadline:
+                break
+        else:
+            time.sleep(READ_DEBOUNCE)
+        self.wake.clear()
+
+def channel_log_paths(config):
+    paths = {}
+    for channel in config['channels']:
+        path = os.path.join(config['sc_path'], f"StarCitizen\\{channel}\\Game.log")
+        if os.path.exists(path):
+            paths[channel] = path
+        else:
+            print(f"No Game.log for {channel} at {path}, skipping it")
+    return paths
+
+def watch_channels(config, observer, spool, poll_interval=POLL_INTERVAL, stats_interval=STATS_INTERVAL):
+    paths = channel_log_paths(config)
+    if not paths:
+        print("Error: none of the configured channels has a Game.log")
+        return
+    buffer = EventBuffer(spool, coalescer=create_coalescer(config))
+    group = LogGroup(paths, buffer, config.get('max_reads_per_second', MAX_READS_PER_SECOND), poll_interval)
+    print("\nTracking events for players:")
+    for watcher in group.watchers:
+        print(f">>> {watcher.channel}: {watcher.player_name} <<<")
+        observer.schedule(watcher, os.path.dirname(watcher.watch_path))
+    import webbrowser
+    webbrowser.open(f'https://picologs.com?player={group.watchers[0].player_name}&version={VERSION}')
+    print("\nPress Ctrl+C to stop...")
+    observer.start()
+
+    next_stats = time.time() + stats_interval
+    try:
+        while True:
+            try:
+                group.check_files()
+                if stats_interval and time.time() >= next_stats:
+                    print(metrics.summary())
+                    next_stats = time.time() + stats_interval
+                group.wait_for_change()
+            except Exception as e:
+                print(f"Error during check: {str(e)}")
+                time.sleep(10)
+    finally:
+        # The checkpoints are already past the states the coalescer holds
+        buffer.flush(final=True)
+
+# Backfill loads the archived session logs the game keeps in logbackups. Files
+# are parsed in parallel worker processes and loaded in large transactions,
+# each file together with its entry in BACKFILL_KEY so a rerun skips it
+BACKFILL_DIR = "logbackups"
+BACKFILL_KEY = "backfill:files"
+BACKFILL_BATCH_SIZE = 5000  # Ops per Redis transaction
+
+class OpCollector:
+    # EventBuffer sink that keeps the ops in memory
+    def __init__(self):
+        self.ops = []
+
+    def write(self, ops):
+        self.ops.extend(ops)
+
+def backfill_id(path):
+    # Archived logs never change, so the start of the file and its size identify it
+    with open(path, 'rb') as file:
+        return f"{file_fingerprint(file)['head']}:{os.fstat(file.fileno()).st_size}"
+
+def tailed_start(path, tailed):
+    # Offset the tracker started reading this log live from, None if it never did
+    starts = []
+    with open(path, 'rb') as file:
+        heads = {}
+        for log in tailed:
+            if log["head_size"] not in heads:
+                heads[log["head_size"]] = file_fingerprint(file, log["head_size"])["head"]
+            if heads[log["head_size"]] == log["head"]:
+                starts.append(log["start"])
+    return min(starts) if starts else None
+
+def parse_archived_log(job):
+    # Runs in a worker process, the parent does all the Redis writes. Only
+    # lines starting before end are read, the rest was tracked live
+    path, end = job
+    try:
+        player_name = find_player_name(path)
+        if player_name is None:
+            print(f"Skipping {os.path.basename(path)}: no player name found")
+            return path, []
+        collector = OpCollector()
+        watcher = FileWatcher(path, buffer=EventBuffer(collector, float("inf"), float("inf")), player_name=player_name)
+        watcher.line_timestamps = True
+        try:
+            position = 0
+            for block in watcher.read_blocks():
+                if end is not None and position + len(block) >= end:
+                    watcher.process_block(block[:block.find(b"\n", max(end - position - 1, 0)) + 1])
+                    break
+                watcher.process_block(block)
+                position += len(block)
+        finally:
+            watcher.close()
+        watcher.buffer.flush()
+        # Ships from old sessions are left out of the fleet, only events are kept
+        return path, [op for op in collector.ops if op[0] == "event"]
+    except Exception as e:
+        print(f"Error reading {os.path.basename(path)}: {str(e)}")
+        return path, None
+
+def backfill(folder, publisher, workers=None):
+    if isinstance(publisher.event_store, StreamEventStore):
+        # The streams are capped, old sessions would push the live events out
+        print("Error: backfill needs JSON storage, the event streams only keep the latest events")
+        return
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(".log"))
+    if not paths:
+        print(f"No logs found in {folder}")
+        return
+    ids = [backfill_id(path) for path in paths]
+    # With the sharded layout each file is recorded in the set of the shard
+    # its events go to, so the set is updated in the same transaction
+    if publisher.sharded:
+        shards = {path: publisher.team or find_player_name(path) for path in paths}
+        pipe = get_redis().pipeline(transaction=False)
+        for path, file_id in zip(paths, ids):
+            # Files loaded before the switch are still recorded in the global set
+            pipe.sismember(shard_key(BACKFILL_KEY, shards[path]), file_id)
+            pipe.sismember(BACKFILL_KEY, file_id)
+        replies = pipe.execute()
+        done = [sharded or legacy for sharded, legacy in zip(replies[::2], replies[1::2])]
+    else:
+        shards = {path: None for path in paths}
+        done = get_redis().smismember(BACKFILL_KEY, ids)
+    todo = {path: file_id for path, file_id, loaded in zip(paths, ids, done) if not loaded}
+    # Logs the tracker read live are only loaded up to where it started
+    tailed = load_tailed_logs()
+    ends = {path: tailed_start(path, tailed) for path in todo}
+    for path, end in ends.items():
+        if end == 0:
+            print(f"Skipping {os.path.basename(path)}: it was tracked live from the start")
+    todo = {path: file_id for path, file_id in todo.items() if ends[path] != 0}
+    print(f"Backfilling {len(todo)} of {len(paths)} logs from {folder}")
+    if not todo:
+        return
+
+    batches = {}  # Shard -> (ops, file ids)
+    files = events = pending = 0
+    started = time.time()
+
+    def send():
+        for shard, (ops, loaded_ids) in batches.items():
+            pipe = shard_pipeline(shard)
+            pipe.sadd(shard_key(BACKFILL_KEY, shard), *loaded_ids)
+            publisher.write(ops, pipe, shard)
+        batches.clear()
+
+    import multiprocessing
+    with multiprocessing.Pool(workers) as pool:
+        for path, file_ops in pool.imap_unordered(parse_archived_log, [(path, ends[path]) for path in todo], chunksize=4):
+            if file_ops is None:
+                continue
+            # A file's ops always go out in one transaction with its id
+            ops, loaded_ids = batches.setdefault(shards[path], ([], []))
+            ops.extend(file_ops)
+            loaded_ids.append(todo[path])
+            files += 1
+            events += len(file_ops)
+            pending += len(file_ops)
+            if pending >= BACKFILL_BATCH_SIZE:
+                send()
+                pending = 0
+    if batches:
+        send()
+    print(f"Loaded {events} events from {files} logs in {time.time() - started:.1f}s")
+
+# migrate-keys copies the global keys into the sharded layout, shard by shard.
+# Run it before clients switch to "key_layout": "sharded". Target keys are
+# written from scratch each run, so an interrupted migration can be run again.
+# backfill:files stays where it is and is still checked by backfill
+MIGRATE_BATCH_SIZE = 1000  # Entries copied per round trip
+
+def migrate_json_array(source, target, shards_of):
+    # Splits a JSON array into one array per shard, keeping the order
+    length = get_redis().json().arrlen(source) or 0
+    created = set()
+    for start in range(0, length, MIGRATE_BATCH_SIZE):
+        items = get_redis().json().get(source, f"$[{start}:{start + MIGRATE_BATCH_SIZE}]")
+        groups = {}
+        for item, shard in zip(items, shards_of(items)):
+            groups.setdefault(shard, []).append(item)
+        for shard, shard_items in groups.items():
+            key = shard_key(target, shard)
+            pipe = shard_pipeline(shard)
+            if key not in created:
+                pipe.json().set(key, "$", [])
+                created.add(key)
+            pipe.json().arrappend(key, "$", *shard_items)
+            pipe.execute()
+    return length, created
+
+def migrate_streams(team=None):
+    # events:<team or player> becomes events:{<team or player>}. Entry IDs are
+    # kept unless several players' streams are merged into one team stream
+    copied = 0
+    created = set()
+    for key in list(get_redis().scan_iter(match="events:*", _type="stream")):
+        key = key.decode()
+        if key_shard(key) is not None:
+            continue
+        shard = team or key[len("events:"):]
+        target = shard_key("events", shard)
+        if target not in created:
+            get_redis().delete(target)
+            created.add(target)
+        last_id = "-"
+        while True:
+            entries = get_redis().xrange(key, min=last_id, count=MIGRATE_BATCH_SIZE)
+            if not entries:
+                break
+            pipe = shard_pipeline(shard)
+            for entry_id, fields in entries:
+                pipe.xadd(target, fields, id=entry_id if team is None else "*")
+            pipe.execute()
+            copied += len(entries)
+            last_id = "(" + entries[-1][0].decode()
+    return copied, created
+
+def migrate_hash_fleet(team=None):
+    copied = 0
+    created = set()
+    for key in list(get_redis().scan_iter(match=fleet_owner_key("*"))):
+        key = key.decode()
+        if key_shard(key) is not None:
+            continue
+        owner = key[len(fleet_owner_key("")):]
+        shard = team or owner
+        ship_ids = [ship_id.decode() for ship_id in get_redis().smembers(key)]
+        read = get_redis().pipeline(transaction=False)
+        for ship_id in ship_ids:
+            read.hgetall(fleet_ship_key(ship_id))
+        pipe = shard_pipeline(shard)
+        pipe.delete(fleet_owner_key(owner, shard))
+        for ship_id, fields in zip(ship_ids, read.execute()):
+            # Ships destroyed since are only left in the owner's index
+            if fields:
+                pipe.hset(fleet_ship_key(ship_id, shard), mapping=fields)
+                pipe.sadd(fleet_owner_key(owner, shard), ship_id)
+                copied += 1
+        pipe.execute()
+        created.add(fleet_owner_key(owner, shard))
+    return copied, created
+
+def index_ship_shards():
+    # Fills SHIP_SHARDS_KEY from the sharded fleet keys
+    shards = {}
+    for key in get_redis().scan_iter(match=shard_key("fleet", "*"), _type="ReJSON-RL"):
+        key = key.decode()
+        for ship in get_redis().json().get(key, "$[*]"):
+            shards[ship["id"]] = key_shard(key)
+    for key in get_redis().scan_iter(match=fleet_owner_key("*", "*")):
+        key = key.decode()
+        for ship_id in get_redis().smembers(key):
+            shards[ship_id.decode()] = key_shard(key)
+    items = list(shards.items())
+    for i in range(0, len(items), MIGRATE_BATCH_SIZE):
+        get_redis().hset(SHIP_SHARDS_KEY, mapping=dict(items[i:i + MIGRATE_BATCH_SIZE]))
+    return len(shards)
+
+def migrate_keys(config, team=None, delete=False):
+    symbols = SymbolTable()
+
+    def compact_shards(payloads):
+        if team:
+            return [team] * len(payloads)
+        symbols.lookup([payload["p"] for payload in payloads])
+        return [symbols.names.get(payload["p"], payload["p"]) for payload in payloads]
+
+    started = time.time()
+    results = [
+        ("events", migrate_json_array("events", "events", lambda events: [team or event["player"] for event in events])),
+        ("events:v1", migrate_json_array("events:v1", "events:v1", compact_shards)),
+        ("fleet", migrate_json_array("fleet", "fleet", lambda ships: [team or ship["owner"] for ship in ships])),
+        ("events:<name> streams", migrate_streams(team)),
+        ("fleet:ship and fleet:owner hashes", migrate_hash_fleet(team)),
+    ]
+    for source, (copied, created) in results:
+        if copied:
+            print(f"{source}: copied {copied} entries into {len(created)} sharded keys")
+    print(f"Indexed the shards of {index_ship_shards()} ships")
+    print(f"Migrated in {time.time() - started:.1f}s")
+
+    if config.get('aggregates', False):
+        rebuild_aggregates({**config, 'key_layout': 'sharded'})
+
+    if delete:
+        patterns = ("events", "events:v1", "fleet", "events:*", fleet_ship_key("*"), fleet_owner_key("*")) + AGGREGATE_PATTERNS
+        deleted = 0
+        for pattern in patterns:
+            keys = [key for key in get_redis().scan_iter(match=pattern, count=1000) if key_shard(key.decode()) is None]
+            for i in range(0, len(keys), 1000):
+                deleted += get_redis().delete(*keys[i:i + 1000])
+        print(f"Deleted {deleted} global keys")
+
+# Retention keeps recent events in Redis and moves older ones to gzipped NDJSON
+# segments on disk, one file per events key and UTC day. Each batch appended
+# to a segment is a gzip member of its own and index.ndjson records where it
+# starts and the time range it covers, so reading a time range back only
+# decompresses the members that overlap it. Redis is trimmed a small batch at
+# a time in short transactions while the writers carry on appending
+RETENTION_BATCH_SIZE = 200  # Events checked and trimmed per transaction
+RETENTION_PAUSE = 0.05  # Seconds between batches, so writers are never queued behind a run
+RETENTION_LOCK = "retention:lock"
+RETENTION_LOCK_SECONDS = 300  # The lock expires if a run dies while holding it
+ARCHIVE_PATH = os.path.join(APP_DATA_PATH, 'archive')
+DAY_SECONDS = 86400
+
+def retention_windows(config):
+    # Seconds each event type stays in Redis, "default" for types not listed
+    return {kind: days * DAY_SECONDS for kind, days in config.get('retention_days', {}).items()}
+
+def expired_indexes(events, windows, now):
+    default = windows.get("default")
+    expired = []
+    for i, event in enumerate(events):
+        window = windows.get(event["type"], default)
+        if window is not None and event_epoch(event) < now - window:
+            expired.append(i)
+    return expired
+
+def archive_name(source):
+    return re.sub(r"[^\w.-]", "_", source)
+
+class Archive:
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        self.index_path = os.path.join(path, "index.ndjson")
+        os.makedirs(path, exist_ok=True)
+        self.last_batches = {}  # Events key -> ID of the last batch archived from it
+        for entry in self.entries():
+            self.last_batches[entry["source"]] = entry["batch"]
+
+    def entries(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        pass  # Left unfinished by a crash
+        except FileNotFoundError:
+            return
+
+    def write(self, source, events, batch):
+        # A run that stopped between archiving and trimming leaves the same
+        # batch at the front, it is trimmed again but not archived twice
+        import gzip
+        if self.last_batches.get(source) == batch:
+            return False
+        days = {}
+        for event in events:
+            epoch = event_epoch(event)
+            days.setdefault(epoch - epoch % DAY_SECONDS, []).append((epoch, event))
+
+        entries = []
+        for day, day_events in sorted(days.items()):
+            segment = f"{archive_name(source)}/{time.strftime('%Y-%m-%d', time.gmtime(day))}.ndjson.gz"
+            path = os.path.join(self.path, *segment.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = gzip.compress("".join(json.dumps(event, separators=(",", ":")) + "\n" for _, event in day_events).encode())
+            with open(path, 'ab') as f:
+                offset = os.fstat(f.fileno()).st_size
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            entries.append({
+                "source": source,
+                "segment": segment,
+                "offset": offset,
+                "length": len(data),
+                "start": min(epoch for epoch, _ in day_events),
+                "end": max(epoch for epoch, _ in day_events),
+                "count": len(day_events),
+                "batch": batch
+            })
+
+        # The segments are on disk before the index points at them
+        with open(self.index_path, 'ab+') as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # After an unfinished line
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_batches[source] = batch
+        return True
+
+    def read(self, start, end, source=None):
+        # Yields archived events with start <= time < end, from the members
+        # whose time range overlaps it
+        import gzip
+        for entry in sorted(self.entries(), key=lambda entry: entry["start"]):
+            if entry["end"] < start or entry["start"] >= end or (source and entry["source"] != source):
+                continue
+            with open(os.path.join(self.path, *entry["segment"].split("/")), 'rb') as f:
+                f.seek(entry["offset"])
+                data = gzip.decompress(f.read(entry["length"]))
+            for line in data.splitlines():
+                event = json.loads(line)
+                if start <= event_epoch(event) < end:
+                    yield event
+
+def expire_json_events(key, compact, windows, archive, now):
+    # Only retention removes entries and writers append at the end, so the
+    # indexes read for a batch are still right when it is trimmed. Backfill
+    # appends old events after newer ones, so the whole array is checked,
+    # up to where it ended when the run started
+    archived = 0
+    position = 0
+    end = get_redis().json().arrlen(key) or 0
+    while position < end:
+        items = get_redis().json().get(key, f"$[{position}:{min(position + RETENTION_BATCH_SIZE, end)}]")
+        if not items:
+            break
+        events = decode_events(items) if compact else items
+        expired = expired_indexes(events, windows, now)
+        if expired:
+            batch = hashlib.sha1(json.dumps([items[i] for i in expired]).encode()).hexdigest()
+            archive.write(key, [events[i] for i in expired], batch)
+            pipe = shard_pipeline(key_shard(key))
+            if position == 0 and expired[-1] == len(expired) - 1:
+                pipe.json().arrtrim(key, "$", len(expired), -1)
+            else:
+                # Events kept for longer are in between, later indexes go first
+                for i in reversed(expired):
+                    pipe.json().arrpop(key, "$", position + i)
+            pipe.execute()
+            archived += len(expired)
+        position += len(items) - len(expired)
+        end -= len(expired)
+        get_redis().expire(RETENTION_LOCK, RETENTION_LOCK_SECONDS)
+        time.sleep(RETENTION_PAUSE)
+    return archived
+
+def stream_id(entry_id):
+    # Stream entry IDs in the order Redis keeps them
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+def expire_stream_events(key, windows, archive, now):
+    # The whole stream is checked up to its last entry when the run started
+    archived = 0
+    last_id = "0-0"
+    newest = get_redis().xrevrange(key, count=1)
+    if not newest:
+        return 0
+    end = stream_id(newest[0][0].decode())
+    while True:
+        entries = read_stream_events(key, last_id, count=RETENTION_BATCH_SIZE)
+        if not entries:
+            break
+        events = [event for _, event in entries]
+        expired = expired_indexes(events, windows, now)
+        if expired:
+            ids = [entries[i][0] for i in expired]
+            archive.write(key, [events[i] for i in expired], hashlib.sha1(" ".join(ids).encode()).hexdigest())
+            get_redis().xdel(key, *ids)
+            archived += len(expired)
+        last_id = entries[-1][0]
+        if stream_id(last_id) >= end:
+            break
+        get_redis().expire(RETENTION_LOCK, RETENTION_LOCK_SECONDS)
+        time.sleep(RETENTION_PAUSE)
+    return archived
+
+def run_retention(config, now=None):
+    windows = retention_windows(config)
+    if not windows:
+        print("Error: set retention_days in config.json first")
+        return
+    # One run at a time, a second one would trim by stale indexes
+    if not get_redis().set(RETENTION_LOCK, os.getpid(), nx=True, ex=RETENTION_LOCK_SECONDS):
+        print("Another retention run is in progress")
+        return
+    try:
+        archive = Archive(config.get('archive_path', ARCHIVE_PATH))
+        now = time.time() if now is None else now
+        streams = config.get('storage', 'json') == 'streams'
+        compact = config.get('event_format', 'legacy') == 'compact'
+        started = time.time()
+        total = 0
+        for key in event_keys(config):
+            if streams:
+                archived = expire_stream_events(key, windows, archive, now)
+            else:
+                archived = expire_json_events(key, compact, windows, archive, now)
+            if archived:
+                print(f"{key}: archived {archived} events")
+            total += archived
+        print(f"Archived {total} events to {archive.path} in {time.time() - started:.1f}s")
+    finally:
+        get_redis().delete(RETENTION_LOCK)
+
+def parse_time(text):
+    # Event timestamps, or a date for midnight UTC
+    for layout in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(text, layout))
+        except ValueError:
+            pass
+    raise ValueError(f"Not a time: {text}, use 2024-09-09 or 2024-09-09T12:00:00Z")
+
 def select_game_log_file():
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()  # Hide the main window
     
@@ -492,35 +2847,150 @@ def select_game_log_file():
     return file_path
 
 def main():
+    parser = argparse.ArgumentParser(description="Picologs - Star Citizen Event Tracker")
+    commands = parser.add_subparsers(dest="command")
+    backfill_parser = commands.add_parser("backfill", help="load archived session logs into Redis")
+    backfill_parser.add_argument("folder", nargs="?", help=f"folder of archived logs, defaults to {BACKFILL_DIR} next to Game.log")
+    backfill_parser.add_argument("--workers", type=int, help="parser processes, defaults to the number of CPUs")
+    commands.add_parser("rebuild-aggregates", help="recompute kill/death counts, leaderboards and session stats from the stored events")
+    listen_parser = commands.add_parser("listen", help="print a team's notifications as they arrive")
+    listen_parser.add_argument("name", nargs="?", help="team or player to listen to, defaults to the configured team")
+    listen_parser.add_argument("--types", help="only these types, comma separated, e.g. kill,death,ship_destroyed")
+    migrate_parser = commands.add_parser("migrate-keys", help="copy the global keys into the sharded key layout")
+    migrate_parser.add_argument("--team", help="put every player's data in this team's shard, defaults to the configured team")
+    migrate_parser.add_argument("--delete", action="store_true", help="delete the global keys once they are copied")
+    commands.add_parser("retention", help="archive events older than retention_days to disk and trim them from Redis")
+    archive_parser = commands.add_parser("read-archive", help="print archived events from a time range as NDJSON")
+    archive_parser.add_argument("start", help="e.g. 2024-09-09 or 2024-09-09T12:00:00Z")
+    archive_parser.add_argument("end", help="end of the range, not included")
+    archive_parser.add_argument("--source", help="only events archived from this key, e.g. events")
+    args = parser.parse_args()
+
     print("\nPicologs - Star Citizen Event Tracker")
     print("=" * 40)
     print("Current version: " + VERSION)
     
     # Check if this is first run
     config = load_or_create_config()
+
+    # A transaction can only touch one cluster slot, which the global keys do not share
+    if redis_settings()[1] and config.get('key_layout', 'global') != 'sharded' and args.command != "migrate-keys":
+        print('Error: Redis Cluster needs "key_layout": "sharded" in config.json')
+        sys.exit(1)
+
+    # The commands need Redis right away, only the tracker can start without it
+    if args.command and args.command != "read-archive" and not check_redis():
+        sys.exit(1)
+
+    if args.command == "backfill":
+        folder = args.folder
+        if folder is None:
+            config = prompt_for_config()
+            folder = os.path.join(os.path.dirname(config['game_log_path']), BACKFILL_DIR)
+        backfill(folder, create_publisher(config, notifications=False, history=True), args.workers)
+        return
+
+    if args.command == "migrate-keys":
+        migrate_keys(config, args.team or config.get('team'), args.delete)
+        return
+
+    if args.command == "retention":
+        run_retention(config)
+        return
+
+    if args.command == "read-archive":
+        archive = Archive(config.get('archive_path', ARCHIVE_PATH))
+        for event in archive.read(parse_time(args.start), parse_time(args.end), args.source):
+            print(json.dumps(event))
+        return
+
+    if args.command == "rebuild-aggregates":
+        rebuild_aggregates(config)
+        return
+
+    if args.command == "listen":
+        name = args.name or config.get('team')
+        if not name:
+            print("Error: give a team or player name, or set team in config.json")
+            return
+        types = args.types.split(",") if args.types else None
+        print(f"Listening for notifications on {notify_channel(name)}, press Ctrl+C to stop...")
+        try:
+            for notification in subscribe_notifications(name, types):
+                print(format_notification(notification))
+        except KeyboardInterrupt:
+            pass
+        return
     
     # Continue with normal operation
     config = prompt_for_config()
+    from watchdog.observers import Observer
+    observer = Observer()
+    spool = Spool()
+    sender = SpoolSender(spool, create_publisher(config))
+    sender.start()
+    buffer = None
     try:    
-        watcher = FileWatcher(config['game_log_path'])
+        poll_interval = config.get('poll_interval', POLL_INTERVAL)
+        exit_on_game_quit = config.get('exit_on_game_quit', False)
+        stats_interval = config.get('stats_interval', STATS_INTERVAL)
+        metrics.gauge("spool_pending_bytes", spool.pending_bytes)
+        if config.get('metrics_port'):
+            start_metrics_server(config['metrics_port'])
+
+        if config.get('channels'):
+            watch_channels(config, observer, spool, poll_interval, stats_interval)
+            return
+
+        buffer = EventBuffer(spool, coalescer=create_coalescer(config))
+        watcher = FileWatcher(
+            config['game_log_path'],
+            buffer=buffer,
+            max_reads_per_second=config.get('max_reads_per_second', MAX_READS_PER_SECOND)
+        )
         print("\nTracking events for player:")
         print(f">>> {watcher.player_name} <<<")
+        import webbrowser
         webbrowser.open(f'https://picologs.com?player={watcher.player_name}&version={VERSION}')
         print("\nPress Ctrl+C to stop...")
-        
+
+        observer.schedule(watcher, os.path.dirname(watcher.watch_path))
+        observer.start()
+
+        if config.get('pipeline', False):
+            Pipeline(watcher, spool, poll_interval, exit_on_game_quit, stats_interval).run()
+            print("\nGame closed, file watching stopped.")
+            return
+
+        next_stats = time.time() + stats_interval
         while True:
             try:
                 watcher.check_file()
-                time.sleep(30)  # Reduced from 5 to 30 seconds
-            except redis.RedisError as e:
-                print(f"Redis Error during check: {str(e)}")
-                time.sleep(30)  # Wait longer on Redis error
+                if watcher.game_quit and exit_on_game_quit:
+                    print("\nGame closed, file watching stopped.")
+                    break
+                watcher.game_quit = False
+                if stats_interval and time.time() >= next_stats:
+                    print(metrics.summary())
+                    next_stats = time.time() + stats_interval
+                watcher.wait_for_change(poll_interval)
             except Exception as e:
                 print(f"Error during check: {str(e)}")
                 time.sleep(10)
                 
     except KeyboardInterrupt:
         print(f"\nFile watching stopped.")
+    finally:
+        if observer.is_alive():
+            observer.stop()
+            observer.join()
+        # The checkpoint is already past the states the coalescer holds
+        if buffer is not None:
+            buffer.flush(final=True)
+        # Anything not sent yet stays in the spool for the next run
+        sender.stop()
  
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()
     main()